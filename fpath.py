@@ -1,18 +1,74 @@
 import os
 import shutil
 import re
+import fnmatch
 import datetime
-from collections import Counter
+from collections import Counter, deque
+try:
+    # Python 3.11以降
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 import sys
+import csv
+from functools import partial
+from itertools import islice
+import mmap
+import codecs
+import stat
+import sqlite3
+import hashlib
+import heapq
+import time
+import errno
+import math
+import random
+import threading
+import tempfile
+import marshal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, as_completed
 
 from lxml import etree
 import pandas as pd
+# Parquet/Featherの出力にのみ使う。無くても他の機能は動く。
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
 
 
 # 0.0.0 Original
 # 0.0.1 Fixed bug on grep
 # 0.1.0 Grep.create_regex()を追加
-__version__ = '0.1.0'
+# 0.2.0 Entry, Mapper.entry_generator()を追加 (os.scandirベースのウォーカー)
+# 0.3.0 Mapper(workers=n)で並列にフォルダを列挙できるようにした。
+# 0.4.0 FileIndex (SQLiteのファイルインデックス)を追加
+# 0.5.0 Criteria, Filter.by_criteria()を追加 (複数条件を一回の走査で判定)
+# 0.6.0 Prune (走査中のフォルダの除外、深さ制限)を追加
+# 0.7.0 Grep.grep(stream=True)を追加 (チャンク読み込みと逐次書き出し)
+# 0.8.0 Grep.grep(use_mmap=True)を追加 (mmap上でbytesの正規表現を実行)
+# 0.9.0 Grep.grep(workers=n)を追加 (複数プロセスでファイルを検索)
+# 0.10.0 Prefilter (正規表現の前にリテラル文字列で候補を絞る)を追加
+# 0.11.0 GrepWriterをチャンク単位の書き出しにし、GrepTableWriter (Parquet/Feather)を追加
+# 0.12.0 Grep.grep_multi()を追加 (複数の正規表現を一回の読み込みで検索)
+# 0.13.0 Xml.map_files()を追加し、Xml.format_files(workers=n)でスレッド並列に整形できるようにした。
+# 0.14.0 Xml.iter_count_tag_names(), Xml.count_tag_names_in()を追加 (iterparseで逐次集計)
+# 0.15.0 Xml.pretty_stream()を追加 (ツリー全体を保持せずに整形して書き出す)
+# 0.16.0 Xml.check()をツリーを作らない整形式チェックにした。
+# 0.17.0 XmlManifest, Xml.map_files_incremental()を追加 (変化の無いXMLファイルの処理を飛ばす)
+# 0.18.0 CopyEngine (複数スレッドでのコピー、Linuxではカーネル内コピー)を追加
+# 0.19.0 CopyEngine(sync=..., dry_run=...)を追加 (出力先が最新のファイルはコピーしない)
+# 0.20.0 DirMaker (作成済みフォルダの記録とmkdirの集計)を追加
+# 0.21.0 DeleteEngine (対象を集めてから並列に削除、dry run)を追加
+# 0.22.0 DiskUsage (フォルダ毎・拡張子毎の集計と最大のファイル・フォルダ)を追加
+# 0.23.0 Duplicate (サイズ→先頭・末尾のハッシュ→全体のハッシュで重複ファイルを探す)を追加
+# 0.24.0 Sorter.sort() (更新日時・サイズ・名前、上位N件はヒープ、大量はディスクで外部マージソート)を追加
+# 0.25.0 DummyGenerator (乱数の種を固定した並列のダミーツリー生成、ログ・XML・バイナリの中身)を追加
+# 0.26.0 DirMakerを処理毎のインスタンスにした。(同時に動く処理の記録と集計が混ざらないように)
+# 0.27.0 Xml.check()をiterparseにした。(名前空間のエラーもXml(fp).errと同じく報告する)
+__version__ = '0.27.0'
 
 
 class Prompt:
@@ -130,58 +186,292 @@ class Prompt:
                 return ret
 
 
+class Entry:
+    """ os.scandir()の結果をキャッシュした軽量レコード。
+    種類(ファイル/フォルダ)はscandirの結果をそのまま使い、
+    サイズと更新日時は最初に必要になった時に一度だけstatする。"""
+    __slots__ = ('path', 'name', '_is_dir', '_is_file', '_dir_entry', '_stat')
+
+    def __init__(self, path, is_dir, is_file, dir_entry=None, stat_result=None):
+        """
+        Constructor
+        :param path: ファイルもしくはフォルダの絶対パス
+        :param is_dir: フォルダか？ True | False
+        :param is_file: ファイルか？ True | False
+        :param dir_entry: os.DirEntry (statのキャッシュに使う)
+        :param stat_result: 取得済みのos.stat_result
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self._is_dir = is_dir
+        self._is_file = is_file
+        self._dir_entry = dir_entry
+        self._stat = stat_result
+
+    @classmethod
+    def from_dir_entry(cls, dir_entry):
+        # is_dir()/is_file()はOSが返すファイル種別を使うので、通常はstatを発行しない。
+        try:
+            is_dir = dir_entry.is_dir()
+        except OSError:
+            is_dir = False
+        # os.walk()と同じく、フォルダ以外(リンク切れのシンボリックリンク等)はファイルとして扱う。
+        return cls(dir_entry.path, is_dir, not is_dir, dir_entry=dir_entry)
+
+    @classmethod
+    def from_record(cls, path, is_dir, is_file, size, mtime):
+        # インデックス等に保存済みのサイズと更新日時から作る。statは発行しない。
+        st = os.stat_result((0, 0, 0, 0, 0, 0, size, 0, mtime, 0))
+        return cls(path, bool(is_dir), bool(is_file), stat_result=st)
+
+    @classmethod
+    def from_path(cls, path):
+        st = os.stat(path)
+        return cls(path, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode), stat_result=st)
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return self._is_file
+
+    def is_symlink(self):
+        # DirEntryがある場合は、scandirの結果を使うのでstatを発行しない。
+        if self._dir_entry is not None:
+            return self._dir_entry.is_symlink()
+        return os.path.islink(self.path)
+
+    def stat(self):
+        # statは一度だけ。DirEntry.stat()自体もキャッシュされる。
+        if self._stat is None:
+            try:
+                if self._dir_entry is None:
+                    self._stat = os.stat(self.path)
+                else:
+                    self._stat = self._dir_entry.stat()
+            except OSError:
+                # リンク切れのシンボリックリンクは、リンク自体のサイズと更新日時にする。
+                st = os.lstat(self.path)
+                if not stat.S_ISLNK(st.st_mode):
+                    raise
+                self._stat = st
+        return self._stat
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f'Entry({self.path!r})'
+
+
+class Prune:
+    """ 走査中に除外するフォルダ(とファイル)の条件。
+    除外されたフォルダには入らないので、配下がどれだけ大きくても走査のコストはかからない。
+    Filter.by_regex()は絶対パスに対して判定するだけなので、走査そのものは止められない。"""
+    # よく除外するフォルダ
+    DEFAULT_GLOBS = ['.git', '.svn', '.hg', 'node_modules', '__pycache__']
+
+    def __init__(self, globs=(), patterns=(), max_depth=None):
+        """
+        Constructor
+        :param globs: 除外する名称のワイルドカード e.g. ['.git', '*.tmp'] (大文字小文字の区別はしない)
+        :param patterns: 除外する絶対パスのコンパイル済み正規表現 (match()で判定する)
+        :param max_depth: 辿る深さの上限。0の場合はpath_in直下のみ。Noneの場合は制限無し。
+        """
+        self.globs = list(globs)
+        self.patterns = list(patterns)
+        self.max_depth = max_depth
+        # ワイルドカードは一つの正規表現にまとめておく。
+        if self.globs:
+            self._glob_ptn = re.compile('|'.join(fnmatch.translate(g) for g in self.globs), re.IGNORECASE)
+        else:
+            self._glob_ptn = None
+
+    def __repr__(self):
+        return (f'Prune(globs={self.globs}, patterns={[p.pattern for p in self.patterns]}, '
+                f'max_depth={self.max_depth})')
+
+    def excludes(self, name, path):
+        # 除外対象か？
+        if self._glob_ptn is not None and self._glob_ptn.match(name):
+            return True
+        for ptn in self.patterns:
+            if ptn.match(path):
+                return True
+        return False
+
+    def descends(self, depth):
+        # 深さdepthのフォルダを列挙するか？ (path_in自体の深さは0)
+        return self.max_depth is None or depth <= self.max_depth
+
+    def allows_path(self, dir_in, path):
+        # 走査済みの結果(FileIndex等)を後から判定する場合。途中のフォルダも含めて判定する。
+        rel = os.path.relpath(path, dir_in)
+        parts = rel.split(os.sep)
+        if not self.descends(len(parts) - 1):
+            return False
+        p = dir_in
+        for part in parts:
+            p = os.path.join(p, part)
+            if self.excludes(part, p):
+                return False
+        return True
+
+
 class Mapper:
     """ フォルダをマッピングする。
     効率化の為、returnせずにyieldする。
-    変数はファイルを探すか、フォルダを探すか、再帰するか、しないか。"""
+    変数はファイルを探すか、フォルダを探すか、再帰するか、しないか。
+    workersを2以上にすると、スレッドプールでサブフォルダを並列に列挙する。
+    (ネットワークドライブ等、フォルダ毎の待ち時間が支配的な場合に有効)
+    pruneを渡すと、除外するフォルダには入らずに済ませる。"""
 
-    def __init__(self, path_in):
+    def __init__(self, path_in, workers=1, ordered=True, prune=None):
         """
         Constructor
         :param path_in: ファイルもしくはフォルダの絶対パス
+        :param workers: フォルダを列挙するスレッド数。1の場合は並列化しない。
+        :param ordered: True の場合、並列でもos.walk()と同じ順番で返す。
+            False の場合、列挙が終わったフォルダから順に返す。
+        :param prune: Prune (除外するフォルダや深さの上限)。Noneの場合は全て辿る。
         """
         self.path_in = path_in
+        self.workers = workers
+        self.ordered = ordered
+        self.prune = prune
 
-    def path_generator(self, search_type='file', recursive=True):
+    @staticmethod
+    def _match_type(entry, search_type):
+        if search_type == 'file':
+            return entry.is_file()
+        elif search_type == 'dir':
+            return entry.is_dir()
+        elif search_type == 'all':
+            return True
+        else:
+            raise ValueError(f'ERROR: {search_type} is not a valid search type!')
+
+    @staticmethod
+    def _is_file_for_listdir(de, search_type):
+        # 子階層のみの場合、ファイルは従来通りos.path.isfile()と同じ判定にする。(リンク切れは含まない)
+        if search_type != 'file':
+            return True
+        try:
+            return de.is_file()
+        except OSError:
+            return False
+
+    @staticmethod
+    def _list_dir(root, search_type, recursive, prefetch_stat=False, prune=None, depth=0):
         """
-        Path Generator
-        :param search_type: 'file' or 'dir' as string
+        List a single folder
+        :param depth: depth of root (path_in = 0)
+        :return: (matched entries, sub folder paths to descend)
+        """
+        matched = []
+        sub_dirs = []
+        descend = recursive and (prune is None or prune.descends(depth + 1))
+        try:
+            with os.scandir(root) as it:
+                for de in it:
+                    # 除外対象は返さないし、フォルダの場合は中にも入らない。
+                    if prune is not None and prune.excludes(de.name, de.path):
+                        continue
+                    entry = Entry.from_dir_entry(de)
+                    if Mapper._match_type(entry, search_type) and (recursive or Mapper._is_file_for_listdir(de, search_type)):
+                        # 並列時はstatもワーカー側で済ませておく。
+                        if prefetch_stat:
+                            try:
+                                entry.stat()
+                            except OSError:
+                                pass
+                        matched.append(entry)
+                    # シンボリックリンクのフォルダには入らない。(os.walk()のfollowlinks=Falseと同じ)
+                    if descend and entry.is_dir() and not de.is_symlink():
+                        sub_dirs.append(entry.path)
+        # os.walk()と同様、読めないフォルダは無視する。
+        except OSError:
+            pass
+        return matched, sub_dirs
+
+    def _scandir(self, dir_in, search_type, recursive):
+        # os.walk()と同じ順番(トップダウン、深さ優先)で辿る。
+        stack = [(dir_in, 0)]
+        while stack:
+            root, depth = stack.pop()
+            matched, sub_dirs = self._list_dir(root, search_type, recursive, prune=self.prune, depth=depth)
+            yield from matched
+            stack.extend((p, depth + 1) for p in reversed(sub_dirs))
+
+    def _scandir_parallel(self, dir_in, search_type, recursive, prefetch_stat):
+        # 先読みするフォルダ数の上限。出力待ちの結果がメモリを圧迫しないように制限する。
+        max_pending = self.workers * 4
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def submit(path, depth):
+            return executor.submit(self._list_dir, path, search_type, recursive, prefetch_stat, self.prune, depth)
+
+        try:
+            if self.ordered:
+                # スタックの要素は[パス, 深さ, Future]。スタックの上(次に必要になる方)から先読みする。
+                stack = [[dir_in, 0, None]]
+                while stack:
+                    in_flight = 0
+                    for node in reversed(stack):
+                        if in_flight >= max_pending:
+                            break
+                        if node[2] is None:
+                            node[2] = submit(node[0], node[1])
+                        in_flight += 1
+                    path, depth, future = stack.pop()
+                    matched, sub_dirs = future.result()
+                    yield from matched
+                    stack.extend([p, depth + 1, None] for p in reversed(sub_dirs))
+            else:
+                # 列挙が終わったフォルダから順に返す。
+                waiting = deque([(dir_in, 0)])
+                running = {}
+                while waiting or running:
+                    while waiting and len(running) < max_pending:
+                        path, depth = waiting.popleft()
+                        running[submit(path, depth)] = depth
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        depth = running.pop(future)
+                        matched, sub_dirs = future.result()
+                        waiting.extend((p, depth + 1) for p in sub_dirs)
+                        yield from matched
+        # 呼び出し側がループを抜けた場合(GeneratorExit)も、未実行のタスクを破棄して終了する。
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def entry_generator(self, search_type='file', recursive=True, prefetch_stat=False):
+        """
+        Entry Generator
+        :param search_type: 'file' | 'dir' | 'all' as string
         :param recursive: True or False as boolean
-        :return: Yield absolute path as string if self.path_in is valid
+        :param prefetch_stat: True の場合、並列時にワーカー側でstatしておく。(サイズや更新日時を使う場合)
+        :return: Yield Entry if self.path_in is valid
         Raise ValueError if self.path_in is neither a file nor a folder.
         """
         # 渡されたパスがフォルダであることを確認する。
         if type(self.path_in) == str:
             if os.path.isdir(self.path_in):
-                # ファイル
-                if search_type == 'file':
-                    # 再帰
-                    if recursive:
-                        for root, dirs, files in os.walk(self.path_in):
-                            for file in files:
-                                yield os.path.join(root, file)
-                    # 子階層のみ
-                    else:
-                        for i in os.listdir(self.path_in):
-                            p = os.path.join(self.path_in, i)
-                            if os.path.isfile(p):
-                                yield p
-                # フォルダ
-                elif search_type == 'dir':
-                    # 再帰
-                    if recursive:
-                        for root, dirs, files in os.walk(self.path_in):
-                            for sub_dir in dirs:
-                                yield os.path.join(root, sub_dir)
-                    # 子階層のみ
-                    else:
-                        for i in os.listdir(self.path_in):
-                            p = os.path.join(self.path_in, i)
-                            if os.path.isdir(p):
-                                yield p
+                if self.workers > 1 and recursive:
+                    yield from self._scandir_parallel(self.path_in, search_type, recursive, prefetch_stat)
+                else:
+                    yield from self._scandir(self.path_in, search_type, recursive)
             # 渡されたパスがファイルの場合
             elif os.path.isfile(self.path_in):
-                yield self.path_in
+                yield Entry.from_path(self.path_in)
             # 渡されたパスがファイルでもフォルダでも無い場合
             else:
                 print('ERROR: Passed string is not a valid file or folder!')
@@ -189,23 +479,361 @@ class Mapper:
         else:
             print(f'ERROR: String is expected as a file path. Type was {type(self.path_in)}!')
 
+    def path_generator(self, search_type='file', recursive=True):
+        """
+        Path Generator
+        :param search_type: 'file' or 'dir' as string
+        :param recursive: True or False as boolean
+        :return: Yield absolute path as string if self.path_in is valid
+        Raise ValueError if self.path_in is neither a file nor a folder.
+        """
+        for entry in self.entry_generator(search_type=search_type, recursive=recursive):
+            yield entry.path
+
+
+class FileIndex:
+    """ フォルダ配下のパス、種類、サイズ、更新日時をSQLiteに保存しておくインデックス。
+    同じフォルダに対してコマンドを何度も実行する場合、毎回フォルダ全体を辿らずに済む。
+
+    更新(refresh)はフォルダの更新日時で差分を判定する。
+    フォルダの更新日時が前回と同じなら、そのフォルダは列挙し直さない。
+    ファイルを上書き編集してもフォルダの更新日時は変わらないので、記録したサイズ・更新日時は古いことがある。
+    そのため、entry_generator()が返すEntryは既定では記録した値を使わず、必要になった時にstatする。
+    (名前だけで選ぶ場合はstatしない。サイズや更新日時で選ぶ場合は候補だけstatする)"""
+
+    # activate()されたインデックス。Filterはここから対象フォルダを含むインデックスを探す。
+    active = {}
+
+    def __init__(self, root, fp_db=None, persist=False):
+        """
+        Constructor
+        :param root: インデックスを作る親フォルダ
+        :param fp_db: SQLiteファイルのパス。Noneの場合はpersistに従う。
+        :param persist: True の場合、ホームフォルダの「.fpath_index」下に作り、次回も使う。
+            False の場合はメモリ上に作り、プロセスの終了で消える。
+        """
+        self.root = os.path.normpath(os.path.abspath(root))
+        if fp_db is None and not persist:
+            fp_db = ':memory:'
+        elif fp_db is None:
+            dir_db = os.path.join(os.path.expanduser('~'), '.fpath_index')
+            os.makedirs(dir_db, exist_ok=True)
+            key = hashlib.sha1(os.path.normcase(self.root).encode('utf-8')).hexdigest()
+            fp_db = os.path.join(dir_db, f'{key}.sqlite3')
+        self.fp_db = fp_db
+        self.auto_refresh = True
+        self.con = sqlite3.connect(fp_db)
+        self.con.executescript("""
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY, parent TEXT NOT NULL,
+    is_dir INTEGER, is_file INTEGER, descend INTEGER, size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS idx_entries_parent ON entries(parent);
+""")
+
+    def __repr__(self):
+        return f'FileIndex({self.root!r}, fp_db={self.fp_db!r})'
+
+    @staticmethod
+    def _prefix_range(dir_in):
+        # 「dir_in + os.sep」で始まるパスを主キーの範囲検索で取得する。
+        lo = dir_in.rstrip(os.sep) + os.sep
+        hi = lo[:-1] + chr(ord(os.sep) + 1)
+        return lo, hi
+
+    def _forget(self, dir_in):
+        # フォルダ配下の記録をすべて削除する。
+        lo, hi = self._prefix_range(dir_in)
+        self.con.execute('DELETE FROM entries WHERE path >= ? AND path < ?', (lo, hi))
+        self.con.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (dir_in, lo, hi))
+
+    def refresh(self, full=False):
+        """
+        Refresh the index incrementally
+        :param full: True の場合、更新日時に関わらず全フォルダを列挙し直す。
+        :return: (scanned folder count, skipped folder count)
+        """
+        scanned = 0
+        skipped = 0
+        cur = self.con.cursor()
+        stack = [self.root]
+        while stack:
+            dir_in = stack.pop()
+            try:
+                mtime = os.stat(dir_in).st_mtime
+            except OSError:
+                self._forget(dir_in)
+                continue
+
+            row = cur.execute('SELECT mtime FROM dirs WHERE path = ?', (dir_in,)).fetchone()
+            # 前回から変化の無いフォルダは、記録済みのサブフォルダだけ辿る。
+            if not full and row is not None and row[0] == mtime:
+                skipped += 1
+                sub_dirs = [r[0] for r in cur.execute(
+                    'SELECT path FROM entries WHERE parent = ? AND descend = 1 ORDER BY path DESC', (dir_in,))]
+                stack.extend(sub_dirs)
+                continue
+
+            # 変化したフォルダは列挙し直す。
+            scanned += 1
+            matched, sub_dirs = Mapper._list_dir(dir_in, 'all', True, prefetch_stat=True)
+            # 消えたサブフォルダの配下を削除する。
+            old_dirs = {r[0] for r in cur.execute(
+                'SELECT path FROM entries WHERE parent = ? AND is_dir = 1', (dir_in,))}
+            for gone in old_dirs.difference(e.path for e in matched if e.is_dir()):
+                self._forget(gone)
+
+            rows = []
+            descend = set(sub_dirs)
+            for entry in matched:
+                try:
+                    size, m_time = entry.size, entry.mtime
+                except OSError:
+                    continue
+                rows.append((entry.path, dir_in, int(entry.is_dir()), int(entry.is_file()),
+                             int(entry.path in descend), size, m_time))
+            cur.execute('DELETE FROM entries WHERE parent = ?', (dir_in,))
+            cur.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            cur.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (dir_in, mtime))
+            stack.extend(reversed(sub_dirs))
+        self.con.commit()
+        print(f'INFO: Index refreshed. scanned={scanned} skipped={skipped} folders')
+        return scanned, skipped
+
+    def covers(self, path_in):
+        # path_inがこのインデックスの対象フォルダ配下か？
+        path_in = os.path.normpath(os.path.abspath(path_in))
+        return path_in == self.root or path_in.startswith(self.root.rstrip(os.sep) + os.sep)
+
+    def entry_generator(self, path_in, search_type='file', recursive=True, cached_stat=False):
+        """
+        Entry Generator answered from the index
+        :param path_in: folder under self.root
+        :param search_type: 'file' | 'dir' | 'all' as string
+        :param recursive: True or False as boolean
+        :param cached_stat: True の場合、記録したサイズ・更新日時を使う。(上書き編集されたファイルは古い値)
+            False の場合、サイズ・更新日時は必要になった時にstatする。
+        :return: Yield Entry in path order. パスはMapperと同じく、path_inに相対パスを繋げた形
+        """
+        dir_in = os.path.normpath(os.path.abspath(path_in))
+        # 記録は正規化した絶対パスなので、path_inの書き方(相対パス等)に戻す。
+        prefix_len = len(dir_in.rstrip(os.sep) + os.sep)
+        if recursive:
+            lo, hi = self._prefix_range(dir_in)
+            sql = 'SELECT path, is_dir, is_file, size, mtime FROM entries WHERE path >= ? AND path < ?'
+            params = (lo, hi)
+        else:
+            sql = 'SELECT path, is_dir, is_file, size, mtime FROM entries WHERE parent = ?'
+            params = (dir_in,)
+
+        if search_type == 'file':
+            sql += ' AND is_file = 1'
+        elif search_type == 'dir':
+            sql += ' AND is_dir = 1'
+        elif search_type != 'all':
+            raise ValueError(f'ERROR: {search_type} is not a valid search type!')
+
+        cur = self.con.execute(sql + ' ORDER BY path', params)
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            for path, is_dir, is_file, size, mtime in rows:
+                path = os.path.join(path_in, path[prefix_len:])
+                if cached_stat:
+                    yield Entry.from_record(path, is_dir, is_file, size, mtime)
+                else:
+                    yield Entry(path, bool(is_dir), bool(is_file))
+
+    def close(self):
+        self.con.close()
+
+    @classmethod
+    def activate(cls, root, fp_db=None, persist=False):
+        """
+        Build/refresh the index of root and let Filter answer from it.
+        :param persist: True = keep the index in the home folder for later runs
+        :return: FileIndex
+        """
+        obj = cls.active.get(os.path.normpath(os.path.abspath(root)))
+        if obj is None:
+            obj = cls(root, fp_db=fp_db, persist=persist)
+            cls.active[obj.root] = obj
+        obj.refresh()
+        return obj
+
+    @classmethod
+    def deactivate(cls, root):
+        obj = cls.active.pop(os.path.normpath(os.path.abspath(root)), None)
+        if obj is not None:
+            obj.close()
+
+    @classmethod
+    def lookup(cls, path_in):
+        # path_inを含むactivate済みのインデックスを返す。無ければNone。
+        if type(path_in) == str and os.path.isdir(path_in):
+            for obj in cls.active.values():
+                if obj.covers(path_in):
+                    return obj
+        return None
+
+
+class Criteria:
+    """ 名称、拡張子、正規表現、サイズ、更新日時の条件をまとめて、一回の走査で判定する。
+    各メソッドはselfを返すので、つなげて書ける。
+        e.g. Criteria().extension('.xml').modified(after=ts)
+    同じ種類の条件はOR、違う種類の条件はANDで判定する。
+    compile()は安い判定(名称・拡張子)から順に並べ、statが必要な判定は最後に回す。"""
+
+    def __init__(self):
+        self.names = set()
+        self.extensions = set()
+        self.patterns = []
+        self.size_min = None
+        self.size_max = None
+        self.mtime_min = None
+        self.mtime_max = None
+
+    def __repr__(self):
+        return (f'Criteria(names={self.names}, extensions={self.extensions}, '
+                f'patterns={[p.pattern for p in self.patterns]}, '
+                f'size=[{self.size_min}, {self.size_max}], mtime=[{self.mtime_min}, {self.mtime_max}])')
+
+    def name(self, *names):
+        # ファイル名もしくはフォルダ名(大文字小文字の区別はしない)
+        self.names.update(n.upper() for n in names)
+        return self
+
+    def extension(self, *extensions):
+        # ドット付きの拡張子 e.g. '.txt' (大文字小文字の区別はしない)
+        # 拡張子無しの場合は空文字 ''
+        self.extensions.update(e.upper() for e in extensions)
+        return self
+
+    def regex(self, pattern):
+        # コンパイル済みの正規表現。Filter.by_regex()と同じく絶対パスに対してmatch()する。
+        self.patterns.append(pattern)
+        return self
+
+    def size(self, min_size=None, max_size=None):
+        # ファイルサイズ(バイト) min_size <= size <= max_size
+        self.size_min = min_size
+        self.size_max = max_size
+        return self
+
+    def modified(self, after=None, before=None):
+        # 更新日時のタイムスタンプ after < mtime <= before
+        self.mtime_min = after
+        self.mtime_max = before
+        return self
+
+    @property
+    def needs_stat(self):
+        return any(v is not None for v in [self.size_min, self.size_max, self.mtime_min, self.mtime_max])
+
+    def compile(self):
+        """
+        Compile the criteria into a single predicate
+        :return: function(Entry) -> bool
+        """
+        checks = []
+        # 1. 名称、拡張子 (文字列の比較のみ)
+        if self.names:
+            names = frozenset(self.names)
+            checks.append(lambda e: e.name.upper() in names)
+        if self.extensions:
+            extensions = frozenset(self.extensions)
+            checks.append(lambda e: os.path.splitext(e.name)[1].upper() in extensions)
+        # 2. 正規表現
+        if self.patterns:
+            patterns = list(self.patterns)
+            checks.append(lambda e: any(p.match(e.path) for p in patterns))
+        # 3. statが必要な判定
+        if self.size_min is not None:
+            size_min = self.size_min
+            checks.append(lambda e: e.size >= size_min)
+        if self.size_max is not None:
+            size_max = self.size_max
+            checks.append(lambda e: e.size <= size_max)
+        if self.mtime_min is not None:
+            mtime_min = self.mtime_min
+            checks.append(lambda e: e.mtime > mtime_min)
+        if self.mtime_max is not None:
+            mtime_max = self.mtime_max
+            checks.append(lambda e: e.mtime <= mtime_max)
+
+        def predicate(entry):
+            for check in checks:
+                if not check(entry):
+                    return False
+            return True
+        return predicate
+
 
 class Filter:
     """ 通常はファイルやフォルダの名称や拡張子で目的のファイルを取得する.
-    複雑な場合は正規表現を使って選別する。"""
+    複雑な場合は正規表現を使って選別する。
+    entries_by_*()はEntryを返すので、後段でサイズや更新日時を再度statせずに済む。
+    workersを2以上にすると、Mapperの並列モードでフォルダを辿る。
+    FileIndexが使える場合(index引数、もしくはactivate済み)は、フォルダを辿らずにインデックスから答える。
+    pruneを渡すと、除外するフォルダの中は辿らない。"""
+    @staticmethod
+    def _walk(path_in, search_type, recursive, workers=1, ordered=True, prefetch_stat=False, index=None,
+              prune=None):
+        # 各フィルターの共通の走査元
+        if index is None:
+            index = FileIndex.lookup(path_in)
+        if index is not None and os.path.isdir(path_in) and index.covers(path_in):
+            if index.auto_refresh:
+                index.refresh()
+            gen = index.entry_generator(path_in, search_type=search_type, recursive=recursive)
+            # インデックスは全件を持っているので、除外条件は後から判定する。
+            if prune is not None:
+                gen = (e for e in gen if prune.allows_path(path_in, e.path))
+            return gen
+
+        mapper = Mapper(path_in, workers=workers, ordered=ordered, prune=prune)
+        return mapper.entry_generator(search_type=search_type, recursive=recursive, prefetch_stat=prefetch_stat)
+
+    @staticmethod
+    def entries_by_base_name(path_in, base_name='__pycache__', search_type='dir', recursive=True,
+                             workers=1, ordered=True, index=None, prune=None):
+        """
+        Search file or folder by base name
+        :param path_in: Parent Folder
+        :param base_name: file name or folder name (case insensitive)
+        :param search_type: 'file' | 'dir'
+        :param recursive: True | False
+        :param workers: thread count to list folders (1 = serial)
+        :param ordered: True | False (keep os.walk() order when workers > 1)
+        :param index: FileIndex to answer from (None = activated index if any)
+        :param prune: Prune to skip excluded sub folders during the walk
+        :return: Entry
+        """
+        base_name = base_name.upper()
+        for entry in Filter._walk(path_in, search_type, recursive, workers, ordered, index=index, prune=prune):
+            if entry.name.upper() == base_name:
+                yield entry
+
     @staticmethod
-    def by_base_name(path_in, base_name='__pycache__', search_type='dir', recursive=True):
+    def by_base_name(path_in, base_name='__pycache__', search_type='dir', recursive=True,
+                     workers=1, ordered=True, index=None, prune=None):
         """
         Search file or folder by base name
         :param path_in: Parent Folder
         :param base_name: file name or folder name (case insensitive)
         :param search_type: 'file' | 'dir'
         :param recursive: True | False
+        :param workers: thread count to list folders (1 = serial)
+        :param ordered: True | False (keep os.walk() order when workers > 1)
+        :param index: FileIndex to answer from (None = activated index if any)
+        :param prune: Prune to skip excluded sub folders during the walk
         :return: Absolute Path
         """
-        for fp in Mapper(path_in).path_generator(search_type=search_type, recursive=recursive):
-            if os.path.basename(fp).upper() == base_name.upper():
-                yield fp
+        for entry in Filter.entries_by_base_name(path_in, base_name=base_name, search_type=search_type,
+                                                 recursive=recursive, workers=workers, ordered=ordered,
+                                                 index=index, prune=prune):
+            yield entry.path
 
     # @staticmethod
     # def by_extension(path_in, extension='.txt', recursive=True):
@@ -223,7 +851,27 @@ class Filter:
     #             yield fp
 
     @staticmethod
-    def by_regex(path_in, pattern=re.compile('.*', re.IGNORECASE), search_type='file', recursive=True):
+    def entries_by_regex(path_in, pattern=re.compile('.*', re.IGNORECASE), search_type='file', recursive=True,
+                         workers=1, ordered=True, index=None, prune=None):
+        """
+        Search files or folders by regular expression
+        :param path_in: parent folder
+        :param pattern: compiled regular expression
+        :param search_type: 'file' | 'dir'
+        :param recursive: True | False
+        :param workers: thread count to list folders (1 = serial)
+        :param ordered: True | False (keep os.walk() order when workers > 1)
+        :param index: FileIndex to answer from (None = activated index if any)
+        :param prune: Prune to skip excluded sub folders during the walk
+        :return: Entry
+        """
+        for entry in Filter._walk(path_in, search_type, recursive, workers, ordered, index=index, prune=prune):
+            if pattern.match(entry.path):
+                yield entry
+
+    @staticmethod
+    def by_regex(path_in, pattern=re.compile('.*', re.IGNORECASE), search_type='file', recursive=True,
+                 workers=1, ordered=True, index=None, prune=None):
         """
         Search files or folders by regular expression
         :param path_in: parent folder
@@ -231,28 +879,179 @@ class Filter:
             If you use regular expression .*ext, it practically functions as endswith.
         :param search_type: 'file' | 'dir'
         :param recursive: True | False
+        :param workers: thread count to list folders (1 = serial)
+        :param ordered: True | False (keep os.walk() order when workers > 1)
+        :param index: FileIndex to answer from (None = activated index if any)
+        :param prune: Prune to skip excluded sub folders during the walk
         :return: absolute file or folder path
         """
-        for fp in Mapper(path_in).path_generator(search_type=search_type, recursive=recursive):
-            if pattern.match(fp):
-                yield fp
+        for entry in Filter.entries_by_regex(path_in, pattern=pattern, search_type=search_type,
+                                             recursive=recursive, workers=workers, ordered=ordered,
+                                             index=index, prune=prune):
+            yield entry.path
 
     @staticmethod
-    def by_modified_time(path_in, ts_min=0.0, search_type='file', recursive=True):
-        for fp in Mapper(path_in).path_generator(search_type=search_type, recursive=recursive):
-            if os.path.getmtime(fp) > ts_min:
-                yield fp
+    def entries_by_modified_time(path_in, ts_min=0.0, search_type='file', recursive=True,
+                                 workers=1, ordered=True, index=None, prune=None):
+        # 更新日時はscandirのstatキャッシュから取得する。並列時はワーカー側でstatする。
+        for entry in Filter._walk(path_in, search_type, recursive, workers, ordered, prefetch_stat=True,
+                                  index=index, prune=prune):
+            if entry.mtime > ts_min:
+                yield entry
+
+    @staticmethod
+    def by_modified_time(path_in, ts_min=0.0, search_type='file', recursive=True,
+                         workers=1, ordered=True, index=None, prune=None):
+        for entry in Filter.entries_by_modified_time(path_in, ts_min=ts_min, search_type=search_type,
+                                                     recursive=recursive, workers=workers, ordered=ordered,
+                                                     index=index, prune=prune):
+            yield entry.path
+
+
+    @staticmethod
+    def entries_by_criteria(path_in, criteria, search_type='file', recursive=True,
+                            workers=1, ordered=True, index=None, prune=None):
+        """
+        Search files or folders by multiple criteria in a single traversal
+        :param path_in: parent folder
+        :param criteria: Criteria
+        :param search_type: 'file' | 'dir'
+        :param recursive: True | False
+        :param workers: thread count to list folders (1 = serial)
+        :param ordered: True | False (keep os.walk() order when workers > 1)
+        :param index: FileIndex to answer from (None = activated index if any)
+        :param prune: Prune to skip excluded sub folders during the walk
+        :return: Entry
+        """
+        predicate = criteria.compile()
+        for entry in Filter._walk(path_in, search_type, recursive, workers, ordered,
+                                  prefetch_stat=criteria.needs_stat, index=index, prune=prune):
+            try:
+                if predicate(entry):
+                    yield entry
+            # 判定中にファイルが消えた場合など
+            except OSError:
+                pass
+
+    @staticmethod
+    def by_criteria(path_in, criteria, search_type='file', recursive=True,
+                    workers=1, ordered=True, index=None, prune=None):
+        for entry in Filter.entries_by_criteria(path_in, criteria, search_type=search_type,
+                                                recursive=recursive, workers=workers, ordered=ordered,
+                                                index=index, prune=prune):
+            yield entry.path
 
 
 class Sorter:
+    """ パスの並べ替え
+    ・limitがある場合は、limit件のヒープだけを持つ。(O(n log limit)、メモリはlimit件)
+    ・limitが無く、件数がmax_in_memoryを超える場合は、並べ替えた塊を一時ファイルに書き出してマージする。"""
+
+    KEYS = ['mtime', 'size', 'name']
+    # メモリ上で並べ替える最大件数。超えた分は一時ファイルに書き出す。
+    MAX_IN_MEMORY = 1000000
+    # 一時ファイルへはこの件数ずつまとめて書き出す。
+    SPILL_BATCH = 4096
+
+    @staticmethod
+    def _mtime(fp):
+        # Entryならキャッシュ済みのstatを使い、文字列ならstatする。
+        if isinstance(fp, Entry):
+            return fp.mtime
+        return os.path.getmtime(fp)
+
+    @staticmethod
+    def _size(fp):
+        if isinstance(fp, Entry):
+            return fp.size
+        return os.path.getsize(fp)
+
+    @staticmethod
+    def _name(fp):
+        # 大文字小文字は区別しない。(同じ名前はパスの順)
+        return os.path.basename(os.fspath(fp)).lower()
+
+    @staticmethod
+    def _records(fp_gen, key):
+        # (キー, パス) 同じキーはパスの順になる。
+        if key not in Sorter.KEYS:
+            raise ValueError(f'key must be one of {Sorter.KEYS}: {key}')
+        fnc = getattr(Sorter, '_' + key)
+        for fp in fp_gen:
+            yield fnc(fp), os.fspath(fp)
+
+    @staticmethod
+    def _spill(records, f):
+        # 並べ替え済みの塊を一時ファイルに書き出す。marshalは同じPythonで読み書きするだけなので十分速い。
+        for i in range(0, len(records), Sorter.SPILL_BATCH):
+            marshal.dump(records[i:i + Sorter.SPILL_BATCH], f)
+        f.seek(0)
+
+    @staticmethod
+    def _read_run(f):
+        while True:
+            try:
+                batch = marshal.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+    @staticmethod
+    def sort(fp_gen, key='mtime', reverse=False, limit=None, max_in_memory=None, dir_tmp=None):
+        """
+        Sort path by mtime, size or name
+        :param fp_gen: generator of absolute path or Entry
+        :param key: 'mtime' | 'size' | 'name'
+        :param reverse: True = descending (newest/largest first)
+        :param limit: yield only the first N paths. 上位N件だけならヒープで選ぶ。
+        :param max_in_memory: record count sorted in memory. 超えたら一時ファイルで外部マージソート
+        :param dir_tmp: folder of the temporary files (None = system default)
+        :return: yield a path
+        """
+        records = Sorter._records(fp_gen, key)
+        if limit is not None:
+            if limit <= 0:
+                return
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            for _, fp in select(limit, records):
+                yield fp
+            return
+
+        max_in_memory = max_in_memory or Sorter.MAX_IN_MEMORY
+        runs = []
+        try:
+            while True:
+                chunk = list(islice(records, max_in_memory))
+                chunk.sort(reverse=reverse)
+                if not runs and len(chunk) < max_in_memory:
+                    # 全部メモリに収まった。
+                    for _, fp in chunk:
+                        yield fp
+                    return
+                if chunk:
+                    f = tempfile.TemporaryFile(dir=dir_tmp)
+                    runs.append(f)
+                    Sorter._spill(chunk, f)
+                if len(chunk) < max_in_memory:
+                    break
+                del chunk
+            # 塊ごとに並べ替え済みなので、マージするだけでよい。
+            for _, fp in heapq.merge(*[Sorter._read_run(f) for f in runs], reverse=reverse):
+                yield fp
+        finally:
+            for f in runs:
+                f.close()
+
     @staticmethod
-    def sort_by_date_modified(fp_gen):
+    def sort_by_date_modified(fp_gen, reverse=False, limit=None):
         """
         Sort path by file modified date in ascending order
+        :param fp_gen: generator of absolute path or Entry
+        :param reverse: True = newest first
+        :param limit: yield only the first N paths
         :return: yield a path
         """
-        for m_time, fp in sorted([(os.path.getmtime(fp), fp) for fp in fp_gen]):
-            yield fp
+        yield from Sorter.sort(fp_gen, key='mtime', reverse=reverse, limit=limit)
 
 
 class DateTime:
@@ -297,6 +1096,13 @@ class DateTime:
 
 
 class Xml:
+    # pretty_stream()の読み込みサイズ。読み込み毎に、完了したルート直下の要素を書き出す。
+    PRETTY_CHUNK = 1024 * 1024
+    # 直下にテキスト(子要素のtail含む)があるか？ libxml2はテキストを含む要素を整形しない。
+    _has_text = etree.XPath('boolean(text())')
+    # check()の読み込みバッファサイズ
+    CHECK_BUFFER = 1024 * 1024
+
     def __init__(self, fp_in):
         # ファイルを開いてパーシングする
         try:
@@ -329,6 +1135,64 @@ class Xml:
         tags = [i.tag for i in self.tree.xpath('//*')]
         return Counter(tags)
 
+    @staticmethod
+    def iter_count_tag_names(fp_in):
+        """
+        Count element names without building the whole tree
+        count_tag_names()と同じ結果になるが、処理済みの要素は捨てるので、メモリはファイルサイズに依存しない。
+        :param fp_in: XML file
+        :return: Counter of element names. None if failed to parse.
+        """
+        counter, err = Xml._count_tag_names(fp_in)
+        if err is not None:
+            print(f"""ERROR: failed to parse {fp_in}.
+\t{err}""")
+        return counter
+
+    @staticmethod
+    def _count_tag_names(fp_in):
+        # iter_count_tag_names()の本体。スレッドから呼ばれるので表示はしない。
+        # (Counter, None) もしくは (None, etree.XMLSyntaxError)
+        counter = Counter()
+        try:
+            # huge_tree: 巨大なテキストノードも受け付ける。
+            for event, elem in etree.iterparse(fp_in, events=('start', 'end'), huge_tree=True):
+                # 開始タグで数えると、集計の順番がxpath('//*')と同じ(文書順)になる。
+                if event == 'start':
+                    counter[elem.tag] += 1
+                    continue
+                # 終了した要素の中身と、処理済みの兄要素を捨てる。
+                # ルート要素の前のコメント等には親が無い。
+                elem.clear(keep_tail=True)
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+        except etree.XMLSyntaxError as e:
+            return None, e
+        return counter, None
+
+    @staticmethod
+    def count_tag_names_in(path_in, workers=1):
+        """
+        Count element names of all XML files in a folder and merge them into one Counter
+        :param path_in: XML file or folder
+        :param workers: thread count
+        :return: (Counter, list of files failed to parse)
+        """
+        total = Counter()
+        bad_lst = []
+        # エラーはワーカーでは表示せず、ここで入力順に表示する。
+        for fp, (counter, err) in Xml.map_files(Xml._count_tag_names, Xml.xml_file_generator(path_in),
+                                                workers=workers):
+            if counter is None:
+                print(f"""ERROR: failed to parse {fp}.
+\t{err}""")
+                bad_lst.append(fp)
+            else:
+                total.update(counter)
+        return total, bad_lst
+
     @staticmethod
     def pretty(fp):
         try:
@@ -351,13 +1215,279 @@ class Xml:
         finally:
             f.close()
 
+    @staticmethod
+    def _write_pretty(fp_in, f, fmt):
+        # pretty_stream()の本体。整形できない(ルート直下にテキストがある)と分かった場合はFalseを返す。
+        # ルートと同じタグ・属性の空要素(シェル)に、処理済みの子要素を移してから書き出すことで、
+        # 子要素のインデントをtostring()全体の場合と同じにする。
+        root = shell = None
+        header = b''
+        opened = False
+        open_tag = close_tag = b''
+
+        def flush():
+            nonlocal opened
+            # ルートのテキストは最初に書き出す部分に含める。
+            if root.text is not None:
+                shell.text = root.text
+                root.text = None
+            if len(shell) == 0 and shell.text is None:
+                return
+            data = etree.tostring(shell, pretty_print=fmt, encoding='utf-8')
+            # シェルの開始タグ・終了タグを除いた中身だけ書き出す。
+            body = data[len(open_tag):data.rindex(close_tag)]
+            if not opened:
+                f.write(open_tag)
+                opened = True
+            # 整形モードでは開始タグの直後の改行が毎回付くので、二回目以降は除く。
+            elif fmt:
+                body = body[1:]
+            f.write(body)
+            shell.text = None
+            del shell[:]
+
+        # 全要素のイベントを受け取ると遅いので、ルートのタグだけを先に調べて、ルートのイベントだけ受け取る。
+        for _, elem in etree.iterparse(fp_in, events=('start',)):
+            root_tag = elem.tag
+            break
+        parser = etree.XMLPullParser(events=('start',), tag=root_tag)
+
+        with open(fp_in, 'rb') as f_in:
+            for data in iter(partial(f_in.read, Xml.PRETTY_CHUNK), b''):
+                parser.feed(data)
+                for _, elem in parser.read_events():
+                    if root is not None:
+                        continue
+                    # ルート要素の開始: XML宣言・DOCTYPE・ルートの前のコメント等を先に書き出す。
+                    # チャンク単位でパースするので、この時点でルートの中身や後ろのノードがあることもある。
+                    root = elem
+                    full = etree.tostring(root.getroottree(), pretty_print=True, encoding='utf-8', xml_declaration=True)
+                    tail = etree.tostring(root, pretty_print=True, encoding='utf-8') + Xml._siblings_after(root)
+                    header = full[:len(full) - len(tail)]
+                    f.write(header)
+                    shell = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+                    # 空要素は「<tag .../>」なので、「/>」を「>」にしたものが開始タグ。
+                    open_tag = etree.tostring(shell, encoding='utf-8')[:-2] + b'>'
+                    shell.text = 'x'
+                    tag = etree.tostring(shell, encoding='utf-8')
+                    close_tag = tag[tag.rindex(b'</'):]
+                    shell.text = None
+                if root is None:
+                    continue
+
+                # ルートにテキストがあれば整形できない。分かった時点でやり直す。
+                if fmt and Xml._has_text(root):
+                    return False
+                # 最後の子要素はパース途中かもしれないので、その手前までをシェルに移して書き出す。
+                if len(root) > 1:
+                    shell[:] = root[:-1]
+                    flush()
+        parser.close()
+
+        # 残りのノードを書き出す。
+        if fmt and Xml._has_text(root):
+            return False
+        shell[:] = root[:]
+        flush()
+
+        # ルートの終了タグと、ルートの後のコメント等
+        if opened:
+            f.write(close_tag)
+        else:
+            f.write(etree.tostring(root, encoding='utf-8'))
+        f.write(b'\n' + Xml._siblings_after(root))
+        return True
+
+    @staticmethod
+    def _siblings_after(root):
+        # ルートの後のコメント・処理命令。tostring()では一つずつ改行が付く。
+        return b''.join(etree.tostring(node, encoding='utf-8') + b'\n' for node in root.itersiblings())
+
+    @staticmethod
+    def pretty_stream(fp_in, fp_out):
+        """
+        Format an XML file and write it in utf-8 without building the whole tree
+        出力はpretty()と同じ。メモリはルート直下の最大の要素の分だけ使う。
+        入力と出力が同じファイルでも良いように、一時ファイルに書いてから置き換える。
+        :param fp_in: XML file
+        :param fp_out: output file
+        :return: True if formatted, False if failed to parse
+        """
+        err = Xml.write_pretty(fp_in, fp_out)
+        if err is not None:
+            print(f"""ERROR: failed to parse {fp_in}.
+\t{err}""")
+        return err is None
+
+    @staticmethod
+    def write_pretty(fp_in, fp_out):
+        """
+        pretty_stream() that returns the error instead of printing it. スレッドから呼ぶ場合はこちら。
+        :return: etree.XMLSyntaxError, None if formatted
+        """
+        fp_tmp = f'{fp_out}.{os.getpid()}.tmp'
+        # 一回で読み込むサイズ以下のファイルは、ツリー全体をtostring()した方が速い。
+        if os.path.getsize(fp_in) <= Xml.PRETTY_CHUNK:
+            try:
+                with open(fp_in, 'rb') as f:
+                    tree = etree.parse(f)
+            except etree.XMLSyntaxError as e:
+                return e
+            with open(fp_tmp, 'wb') as f:
+                f.write(etree.tostring(tree, pretty_print=True, encoding='utf-8', xml_declaration=True))
+            os.replace(fp_tmp, fp_out)
+            return None
+
+        try:
+            with open(fp_tmp, 'wb') as f:
+                # ルート直下にテキストがあると分かったら、整形無しでやり直す。
+                if not Xml._write_pretty(fp_in, f, fmt=True):
+                    f.seek(0)
+                    f.truncate()
+                    Xml._write_pretty(fp_in, f, fmt=False)
+        except etree.XMLSyntaxError as e:
+            os.remove(fp_tmp)
+            return e
+        os.replace(fp_tmp, fp_out)
+        return None
+
+    @staticmethod
+    def check(fp):
+        """
+        Check if the XML file is well-formed without keeping the tree
+        最初のエラーで止まる。エラー情報(メッセージ、行、列)はXml(fp).errと同じ。
+        :param fp: XML file
+        :return: etree.XMLSyntaxError, None if well-formed
+            スレッドから呼ばれるので、エラーは表示せずに返す。(表示は呼び出し側で入力順に行う)
+        """
+        # ターゲット(target=)を指定したパーサーは名前空間のエラー(未定義の接頭辞)を報告しないので、
+        # Xml(fp)と同じパーサーのiterparseを使い、終了した要素を捨てる。
+        try:
+            with open(fp, 'rb', buffering=Xml.CHECK_BUFFER) as f:
+                # 空のファイルはiterparseだとエラーのメッセージと位置が異なる。(中身が無いのでparseしても軽い)
+                if os.fstat(f.fileno()).st_size == 0:
+                    etree.parse(f)
+                for _, elem in etree.iterparse(f, events=('end',)):
+                    elem.clear(keep_tail=True)
+                    parent = elem.getparent()
+                    if parent is not None:
+                        while elem.getprevious() is not None:
+                            del parent[0]
+        except etree.XMLSyntaxError as e:
+            return e
+        return None
+
+    @staticmethod
+    def map_files(fnc, fp_gen, workers=1, max_pending=None):
+        """
+        Apply fnc to each file and yield the results in input order
+        lxmlはパース・シリアライズ中にGILを解放するので、スレッドで並列化できる。
+        :param fnc: function that takes a file path
+        :param fp_gen: generator of file paths
+        :param workers: thread count (1 = run in this thread)
+        :param max_pending: max files in flight (default: workers * 4)
+            処理中・処理済みのツリーがメモリに溜まり過ぎないように、先行して渡すファイル数を制限する。
+        :return: yield (file path, return value of fnc)
+        """
+        if workers <= 1:
+            for fp in fp_gen:
+                yield fp, fnc(fp)
+            return
+
+        if max_pending is None:
+            max_pending = workers * 4
+        executor = ThreadPoolExecutor(max_workers=workers)
+        it = iter(fp_gen)
+        pending = deque()
+
+        def submit_next(n):
+            for fp_next in islice(it, n):
+                pending.append((fp_next, executor.submit(fnc, fp_next)))
+
+        # 結果は渡した順に取り出すので、集計や出力の順番は直列の場合と同じになる。
+        try:
+            submit_next(max_pending)
+            while pending:
+                fp, future = pending.popleft()
+                ret = future.result()
+                submit_next(1)
+                yield fp, ret
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def map_files_incremental(fnc, fp_gen, manifest, to_result, workers=1, required=None):
+        """
+        map_files() that skips files unchanged since the last run
+        :param fnc: function that takes a file path
+        :param fp_gen: generator of file paths
+        :param manifest: XmlManifest
+        :param to_result: function that converts the return value of fnc into the result to record
+            None = OK, str = error message
+        :param workers: thread count
+        :param required: function that takes a file path and returns a path that must exist to skip the file
+            if the last result was OK (e.g. the output file)
+        :return: yield (file path, result, skipped)
+            skipped の場合、resultは前回記録した結果
+        """
+        def lookup_gen():
+            # メタデータの確認は呼び出し側のスレッドで行う。
+            for fp in fp_gen:
+                hit, result = manifest.lookup(fp, required=None if required is None else required(fp))
+                yield fp, hit, result
+
+        def run(item):
+            fp, hit, result = item
+            if hit:
+                return result, None
+            result = to_result(fnc(fp))
+            # 処理後の内容(上書きした場合は整形後の内容)を記録する。
+            return result, XmlManifest.snapshot(fp)
+
+        try:
+            for (fp, hit, _), (result, snap) in Xml.map_files(run, lookup_gen(), workers=workers):
+                if not hit:
+                    manifest.record(fp, snap, result)
+                yield fp, result, hit
+        finally:
+            manifest.commit()
+
+    @staticmethod
+    def format_file(fp_in, dir_in=None, dir_out=None, dir_maker=None):
+        """
+        Format one XML file. Called from threads by format_files().
+        :param fp_in: XML file
+        :param dir_in: root folder of fp_in
+        :param dir_out: output folder (None = overwrite)
+        :param dir_maker: DirMaker shared by the threads of one run (None = no record)
+        :return: etree.XMLSyntaxError, None if formatted
+        """
+        # 上書きするか？により出力先のファイルを決定する。
+        if dir_out is None:
+            fp_out = fp_in
+        else:
+            rp = PathRelative(dir_src=dir_in, abs_src=fp_in, dir_dst=dir_out)
+            fp_out = rp.abs_dst
+            # 中間フォルダを作る。(スレッドから呼ばれるので表示はしない。作った数はdir_maker.report())
+            rp.make_parent_dir(verbose=False, dir_maker=dir_maker)
+
+        # 整形しながらファイルに書き込みする。エラーは呼び出し側で表示する。
+        return Xml.write_pretty(fp_in, fp_out)
+
+    @staticmethod
+    def output_path(fp_in, dir_in=None, dir_out=None):
+        # format_file()の出力先
+        if dir_out is None:
+            return fp_in
+        return PathRelative(dir_src=dir_in, abs_src=fp_in, dir_dst=dir_out).abs_dst
+
     @staticmethod
     def xml_file_generator(path_in):
         for fp in Filter.by_regex(path_in=path_in, pattern=re.compile('.*xml', re.IGNORECASE)):
             yield fp
 
     @staticmethod
-    def format_files(path_in=None):
+    def format_files(path_in=None, workers=1, incremental=False):
         # XML ファイルの格納された親フォルダを取得する。
         if path_in is None:
             path_in = Prompt('Folder with XML files or XML file: ').get_file_or_dir()
@@ -376,48 +1506,51 @@ class Xml:
 
         # 入力がファイルの場合
         if os.path.isfile(path_in):
-            # ファイルを読み込む
-            ret = Xml.pretty(path_in)
             fp_in = path_in
-            if ret is None:
-                bad += 1
-                bad_lst.append(fp_in)
+            # 上書きするか？により出力先のファイルを決定する。
+            if over_write:
+                fp_out = fp_in
             else:
+                fp_out = os.path.join(dir_out, os.path.basename(fp_in))
+            # 整形しながらファイルに書き込みする。
+            if Xml.pretty_stream(fp_in, fp_out):
                 good += 1
-                # 上書きするか？により出力先のファイルを決定する。
-                if over_write:
-                    fp_out = fp_in
-                else:
-                    fp_out = os.path.join(dir_out, os.path.basename(fp_in))
-                # ファイルに書き込みする。
-                with open(fp_out, 'wb') as f:
-                    f.write(ret)
+            else:
+                bad += 1
+                bad_lst.append(fp_in)
 
         # 入力がフォルダの場合
         elif os.path.isdir(path_in):
             dir_in = path_in
-            # ループ
-            for fp_in in Filter.by_regex(dir_in, pattern=re.compile('.*xml', re.IGNORECASE)):
-                # ファイルを読み込む
-                ret = Xml.pretty(fp_in)
-                if ret is None:
+            fp_gen = Filter.by_regex(dir_in, pattern=re.compile('.*xml', re.IGNORECASE))
+            dir_maker = DirMaker()
+            fnc = partial(Xml.format_file, dir_in=dir_in, dir_out=dir_out, dir_maker=dir_maker)
+            # 前回から変化の無いファイルを飛ばす場合
+            if incremental:
+                manifest = XmlManifest(dir_in, task=XmlManifest.pretty_task(dir_out))
+                required = None if over_write else partial(Xml.output_path, dir_in=dir_in, dir_out=dir_out)
+                results = Xml.map_files_incremental(fnc, fp_gen, manifest, XmlManifest.pretty_result,
+                                                    workers=workers, required=required)
+                results = ((fp, result) for fp, result, _ in results)
+            else:
+                results = ((fp, XmlManifest.pretty_result(err))
+                           for fp, err in Xml.map_files(fnc, fp_gen, workers=workers))
+
+            # ループ (カウンターとエラーの表示は呼び出し側のスレッドだけで、入力順に行う)
+            for fp_in, result in results:
+                if result is None:
+                    good += 1
+                else:
+                    print(f"""ERROR: failed to parse {fp_in}.
+\t{result}""")
                     bad += 1
                     bad_lst.append(fp_in)
-                else:
-                    good += 1
-                    # 上書きするか？により出力先のファイルを決定する。
-                    if over_write:
-                        fp_out = fp_in
-                    else:
-                        rp = PathRelative(dir_src=dir_in, abs_src=fp_in, dir_dst=dir_out)
-                        fp_out = rp.abs_dst
-
-                        # 中間フォルダを作る。
-                        rp.make_parent_dir()
-
-                    # ファイルに書き込みする。
-                    with open(fp_out, 'wb') as f:
-                        f.write(ret)
+            if incremental:
+                manifest.report()
+                manifest.close()
+            # 出力先にフォルダを作った場合のmkdirの集計
+            if not over_write:
+                dir_maker.report()
 
         # 入力がファイルの場合
         else:
@@ -434,17 +1567,148 @@ class Xml:
                 print(f'\t{fp}')
 
 
-class Dummy:
-    @staticmethod
-    def dummy_tree(dir_out=None, depth=2, count=5):
-        # ユーザー入力
-        if dir_out is None:
-            print('Folder is not set yet.')
-            dir_out = Prompt('Output folder: ').get_dir()
+class XmlManifest:
+    """ XMLファイルのサイズ、更新日時、内容のハッシュと、前回の処理結果をSQLiteに保存しておく。
+    前回から変化の無いファイルは、処理せずに前回の結果を使う。
 
-        # 渡されたパスがフォルダの場合、フォルダを削除して空フォルダを再構築する。
-        if os.path.isdir(dir_out):
-            shutil.rmtree(dir_out)
+    サイズと更新日時が同じなら変化無しとする。(ファイルは読まない)
+    サイズが同じで更新日時だけ違う場合は、ハッシュを比べる。
+    処理の種類(task)毎に結果を分けて記録する。e.g. 'check', 'pretty', 'pretty:<出力フォルダ>'"""
+
+    # ハッシュ計算の読み込みサイズ
+    CHUNK_SIZE = 1024 * 1024
+    # 何件記録する毎にコミットするか
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, root, task, fp_db=None):
+        """
+        Constructor
+        :param root: XMLファイルの親フォルダ
+        :param task: 処理の種類
+        :param fp_db: SQLiteファイルのパス。Noneの場合はホームフォルダの「.fpath_manifest」下に作る。
+        """
+        self.root = os.path.normpath(os.path.abspath(root))
+        self.task = task
+        if fp_db is None:
+            dir_db = os.path.join(os.path.expanduser('~'), '.fpath_manifest')
+            os.makedirs(dir_db, exist_ok=True)
+            key = hashlib.sha1(os.path.normcase(self.root).encode('utf-8')).hexdigest()
+            fp_db = os.path.join(dir_db, f'{key}.sqlite3')
+        self.fp_db = fp_db
+        self.hit = 0
+        self.miss = 0
+        self.pending = 0
+        self.con = sqlite3.connect(fp_db)
+        self.con.executescript("""
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT, task TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, result TEXT,
+    PRIMARY KEY (path, task));
+""")
+
+    def __repr__(self):
+        return f'XmlManifest({self.root!r}, task={self.task!r}, fp_db={self.fp_db!r})'
+
+    @staticmethod
+    def pretty_task(dir_out=None):
+        # 整形の結果は出力先毎に分ける。
+        if dir_out is None:
+            return 'pretty'
+        return f'pretty:{os.path.normpath(os.path.abspath(dir_out))}'
+
+    @staticmethod
+    def check_result(err):
+        # Xml.check()の戻り値を記録する結果に変換する。
+        return None if err is None else str(err)
+
+    @staticmethod
+    def pretty_result(err):
+        # Xml.format_file()の戻り値を記録する結果に変換する。
+        return None if err is None else str(err)
+
+    @staticmethod
+    def digest(fp):
+        # 内容のハッシュ
+        h = hashlib.sha1()
+        with open(fp, 'rb') as f:
+            for data in iter(partial(f.read, XmlManifest.CHUNK_SIZE), b''):
+                h.update(data)
+        return h.hexdigest()
+
+    @staticmethod
+    def snapshot(fp):
+        # (サイズ, 更新日時, ハッシュ) 別スレッドから呼ばれる。
+        st = os.stat(fp)
+        return st.st_size, st.st_mtime_ns, XmlManifest.digest(fp)
+
+    def lookup(self, fp, required=None):
+        """
+        Check if the file is unchanged since the last record
+        :param fp: file path
+        :param required: path that must exist if the last result was OK (e.g. the output file)
+        :return: (unchanged, result of the last record)
+        """
+        path = os.path.normpath(os.path.abspath(fp))
+        row = self.con.execute('SELECT size, mtime_ns, digest, result FROM files WHERE path = ? AND task = ?',
+                               (path, self.task)).fetchone()
+        try:
+            st = os.stat(path)
+        except OSError:
+            row = None
+        # 前回正常だった場合は、出力ファイルが残っていることも確認する。
+        if row is not None and row[3] is None and required is not None and not os.path.exists(required):
+            row = None
+        if row is not None:
+            size, mtime_ns, digest, result = row
+            if size == st.st_size and mtime_ns == st.st_mtime_ns:
+                self.hit += 1
+                return True, result
+            # 更新日時だけ変わった場合(touchなど)は、内容を比べる。
+            if size == st.st_size and digest == XmlManifest.digest(path):
+                self.con.execute('UPDATE files SET mtime_ns = ? WHERE path = ? AND task = ?',
+                                 (st.st_mtime_ns, path, self.task))
+                self.hit += 1
+                return True, result
+        self.miss += 1
+        return False, None
+
+    def record(self, fp, snap, result):
+        """
+        Record the result of a file
+        :param fp: file path
+        :param snap: return value of snapshot()
+        :param result: None = OK, str = error message
+        """
+        path = os.path.normpath(os.path.abspath(fp))
+        size, mtime_ns, digest = snap
+        self.con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                         (path, self.task, size, mtime_ns, digest, result))
+        self.pending += 1
+        if self.pending >= XmlManifest.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.con.commit()
+        self.pending = 0
+
+    def report(self):
+        print(f'INFO: Skipped {self.hit} unchanged files. Processed {self.miss} files.')
+
+    def close(self):
+        self.commit()
+        self.con.close()
+
+
+class Dummy:
+    @staticmethod
+    def dummy_tree(dir_out=None, depth=2, count=5):
+        # ユーザー入力
+        if dir_out is None:
+            print('Folder is not set yet.')
+            dir_out = Prompt('Output folder: ').get_dir()
+
+        # 渡されたパスがフォルダの場合、フォルダを削除して空フォルダを再構築する。
+        if os.path.isdir(dir_out):
+            shutil.rmtree(dir_out)
             os.makedirs(dir_out)
         # 渡されたパスがフォルダじゃなければ、そこで終了。
         else:
@@ -488,6 +1752,263 @@ class Dummy:
         print(f'File size is {os.path.getsize(fp)}.')
 
 
+class DummyGenerator:
+    """ 負荷試験用のダミーツリーを作る。(対話無し)
+    ・乱数の種はseedとフォルダの相対パスから作るので、スレッド数や実行順に関わらず同じ中身になる。
+    ・フォルダ単位でスレッドに割り振り、ファイルの中身はメモリ上で組み立ててから一度に書き込む。
+    ・進捗はprogress_interval秒に一度だけ表示する。"""
+
+    # 拡張子 -> 重み
+    EXT_MIX = {'.log': 4, '.xml': 3, '.txt': 2, '.bin': 1}
+    SIZE_DISTS = ['fixed', 'uniform', 'lognormal']
+    TEXT_EXTS = {'.log', '.txt', '.csv', '.tsv'}
+    XML_EXTS = {'.xml'}
+    LEVELS = ['INFO', 'WARN', 'ERROR', 'DEBUG']
+    # 書き込みバッファ
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, dir_out, fan_out=10, depth=2, files_per_dir=10, size_min=1024, size_max=1024 * 1024,
+                 size_dist='lognormal', ext_mix=None, corrupt_ratio=0.0, seed=0, workers=4, progress_interval=5.0):
+        """
+        Constructor
+        :param dir_out: output folder (missing or empty)
+        :param fan_out: sub folders per folder
+        :param depth: sub folder levels (0 = files in dir_out only)
+        :param files_per_dir: files per folder
+        :param size_min: minimum file size in bytes
+        :param size_max: maximum file size in bytes
+        :param size_dist: 'fixed' (size_min) | 'uniform' | 'lognormal' (median = geometric mean of min and max)
+        :param ext_mix: dict of extension -> weight. .log/.txt/.csv/.tsv はログ、.xml はXML、他はバイナリ
+        :param corrupt_ratio: ratio of XML files to make broken (0.0 - 1.0)
+        :param seed: random seed
+        :param workers: thread count
+        :param progress_interval: seconds between progress lines (0 = silent)
+        """
+        if size_dist not in DummyGenerator.SIZE_DISTS:
+            raise ValueError(f'size_dist must be one of {DummyGenerator.SIZE_DISTS}: {size_dist}')
+        self.dir_out = dir_out
+        self.fan_out = fan_out
+        self.depth = depth
+        self.files_per_dir = files_per_dir
+        self.size_min = max(0, size_min)
+        self.size_max = max(self.size_min, size_max)
+        self.size_dist = size_dist
+        self.ext_mix = dict(ext_mix or DummyGenerator.EXT_MIX)
+        self.corrupt_ratio = corrupt_ratio
+        self.seed = seed
+        self.workers = max(1, workers)
+        self.progress_interval = progress_interval
+        self.dirs = 0
+        self.files = 0
+        self.bytes = 0
+        self.corrupt = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return (f'DummyGenerator({self.dir_out!r}, fan_out={self.fan_out}, depth={self.depth}, '
+                f'files_per_dir={self.files_per_dir}, seed={self.seed})')
+
+    def rel_dirs(self):
+        # 作るフォルダの相対パス('.'はdir_out)。浅い順なので、親は先に投入される。
+        level = ['.']
+        yield '.'
+        for _ in range(self.depth):
+            nxt = []
+            for rel in level:
+                for i in range(self.fan_out):
+                    child = f'd{i:03d}' if rel == '.' else os.path.join(rel, f'd{i:03d}')
+                    yield child
+                    nxt.append(child)
+            level = nxt
+
+    def file_size(self, rnd):
+        if self.size_dist == 'fixed' or self.size_min == self.size_max:
+            return self.size_min
+        if self.size_dist == 'uniform':
+            return rnd.randint(self.size_min, self.size_max)
+        # 小さいファイルが多く、大きいファイルが少ない分布
+        median = math.sqrt(max(self.size_min, 1) * self.size_max)
+        return min(self.size_max, max(self.size_min, int(rnd.lognormvariate(math.log(median), 1.0))))
+
+    @staticmethod
+    def log_text(rnd, size):
+        # sizeバイト前後のログ。行の途中では切らない。
+        lines = []
+        total = 0
+        i = 0
+        levels = DummyGenerator.LEVELS
+        while total < size:
+            # 1行分の乱数を一度に取り、各項目に切り分ける。(randintを項目毎に呼ぶより速い)
+            r = rnd.getrandbits(64)
+            line = (f'2024-01-{r % 28 + 1:02d} {(r >> 5) % 24:02d}:{(r >> 10) % 60:02d}:{(r >> 16) % 60:02d} '
+                    f'[{levels[(r >> 22) & 3]}] id=({(r >> 24) % 19999 - 9999}) '
+                    f'addr=0x{(r >> 40) & 0xFFFFFF:06x} message {i}\n')
+            lines.append(line)
+            total += len(line)
+            i += 1
+        return ''.join(lines).encode('ascii')
+
+    @staticmethod
+    def xml_text(rnd, size, corrupt=False):
+        # sizeバイト前後のXML。corruptの場合は、閉じタグの欠落か途中での切断で壊す。
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<root>\n']
+        total = len(parts[0])
+        i = 0
+        while total < size:
+            r = rnd.getrandbits(64)
+            part = (f'  <item no="{i}" kind="{"abcde"[r % 5]}"><name>name {(r >> 3) % 100000}</name>'
+                    f'<value>{(r >> 20) % 1000000 / 1000000:.6f}</value></item>\n')
+            parts.append(part)
+            total += len(part)
+            i += 1
+        parts.append('</root>\n')
+        data = ''.join(parts).encode('utf-8')
+        if corrupt:
+            if rnd.random() < 0.5:
+                data = data[:max(len(data) // 2, 1)]
+            else:
+                data = data.replace(b'</name>', b'', 1)
+        return data
+
+    def _make_dir(self, rel):
+        """
+        Make a folder and its files. 別スレッドから呼ばれる。
+        :param rel: relative folder path
+        :return: (file count, bytes, corrupt count)
+        """
+        # 相対パスから乱数の種を作るので、実行順に関わらず同じ中身になる。
+        rnd = random.Random(f'{self.seed}:{rel}')
+        dp = os.path.join(self.dir_out, rel) if rel != '.' else self.dir_out
+        os.makedirs(dp, exist_ok=True)
+        exts = list(self.ext_mix)
+        weights = [self.ext_mix[ext] for ext in exts]
+        total = 0
+        corrupt = 0
+        for i in range(self.files_per_dir):
+            ext = rnd.choices(exts, weights)[0]
+            size = self.file_size(rnd)
+            if ext in DummyGenerator.TEXT_EXTS:
+                data = DummyGenerator.log_text(rnd, size)
+            elif ext in DummyGenerator.XML_EXTS:
+                bad = rnd.random() < self.corrupt_ratio
+                corrupt += bad
+                data = DummyGenerator.xml_text(rnd, size, corrupt=bad)
+            else:
+                data = rnd.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+            with open(os.path.join(dp, f'f{i:05d}{ext}'), 'wb', buffering=DummyGenerator.BUFFER_SIZE) as f:
+                f.write(data)
+            total += len(data)
+        return self.files_per_dir, total, corrupt
+
+    def _progress(self, t0, done=False):
+        sec = max(time.perf_counter() - t0, 1e-9)
+        print(f'{"Done" if done else "INFO"}: {self.dirs:,} folders, {self.files:,} files, {self.bytes:,} bytes, '
+              f'{self.files / sec:,.0f} files/s')
+
+    def run(self):
+        """
+        Generate the tree
+        :return: self (None if dir_out is not empty)
+        """
+        if os.path.isdir(self.dir_out) and os.listdir(self.dir_out):
+            print(f'ERROR: {self.dir_out} is not empty.')
+            return None
+        t0 = time.perf_counter()
+        t_shown = t0
+
+        # 投入中のフォルダ数を制限して、フォルダの一覧を全部持たないようにする。
+        max_pending = self.workers * 4
+        pending = set()
+
+        def collect(futures):
+            nonlocal t_shown
+            for future in futures:
+                files, size, corrupt = future.result()
+                self.dirs += 1
+                self.files += files
+                self.bytes += size
+                self.corrupt += corrupt
+            if self.progress_interval and time.perf_counter() - t_shown >= self.progress_interval:
+                t_shown = time.perf_counter()
+                self._progress(t0)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for rel in self.rel_dirs():
+                pending.add(executor.submit(self._make_dir, rel))
+                if len(pending) >= max_pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            collect(as_completed(pending))
+        self.seconds = time.perf_counter() - t0
+        if self.progress_interval:
+            self._progress(t0, done=True)
+        return self
+
+
+class DirMaker:
+    """ 作成済み(もしくは存在を確認済み)のフォルダを記録して、
+    同じフォルダに何度もmakedirsを呼ばないようにする。
+    makedirsの呼び出し回数と時間も集計するので、report()で省略できた回数が分かる。
+
+    処理(コピー、整形など)毎にインスタンスを作って渡す。記録と集計はその処理の間だけ有効で、
+    同時に動いている他の処理とは共有しない。
+    要注意： 記録後に他のプロセスがフォルダを削除した場合は分からない。"""
+
+    def __init__(self):
+        self.made = set()
+        self.lock = threading.Lock()
+        # makedirsの呼び出し回数、実際に作ったフォルダ数、記録により省略した回数、makedirsの合計時間
+        self.calls = 0
+        self.created = 0
+        self.cached = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f'DirMaker(made={len(self.made)}, calls={self.calls}, cached={self.cached})'
+
+    def make(self, dp):
+        """
+        Make a folder and its parents unless already made
+        複数スレッドから呼んでも良い。
+        :param dp: folder path
+        :return: True if the folder was created by this call
+        """
+        if dp in self.made:
+            with self.lock:
+                self.cached += 1
+            return False
+
+        t0 = time.perf_counter()
+        try:
+            os.makedirs(dp)
+            created = True
+        except FileExistsError:
+            created = False
+        sec = time.perf_counter() - t0
+
+        with self.lock:
+            self.made.add(dp)
+            self.calls += 1
+            self.created += int(created)
+            self.seconds += sec
+        return created
+
+    def reset(self):
+        with self.lock:
+            self.made.clear()
+            self.calls = 0
+            self.created = 0
+            self.cached = 0
+            self.seconds = 0.0
+
+    def report(self):
+        print(f"""=== mkdir ===
+Created     : {self.created:>16,}
+mkdir calls : {self.calls:>16,}
+Cached      : {self.cached:>16,}
+Seconds     : {self.seconds:>16.3f}""")
+
+
 class PathRelative:
     def __init__(self, dir_src, abs_src, dir_dst=None):
         # ■　考慮するシナリオ
@@ -541,15 +2062,22 @@ Destination:
 \tdestination data absolute path parent: {self.abs_dst_parent}
 """
 
-    def make_parent_dir(self):
-        # 出力フォルダに中間のフォルダパスを作る。
-        if self.rel_src_parent:
+    def make_parent_dir(self, verbose=True, dir_maker=None):
+        # 出力フォルダに中間のフォルダパスを作る。作成済みのフォルダはdir_maker(処理毎のDirMaker)が覚えている。
+        # dir_makerが無い場合は、記録も集計もせずに毎回makedirsする。
+        # スレッドから呼ぶ場合はverbose=Falseにして、表示の順番が乱れないようにする。
+        if not self.rel_src_parent:
+            return
+        if dir_maker is not None:
+            created = dir_maker.make(self.abs_dst_parent)
+        else:
             try:
                 os.makedirs(self.abs_dst_parent)
+                created = True
             except FileExistsError:
-                pass
-            else:
-                print(f'Created {self.abs_dst_parent}')
+                created = False
+        if created and verbose:
+            print(f'Created {self.abs_dst_parent}')
 
     def copy(self):
         # ファイル
@@ -599,71 +2127,1131 @@ pause
         print(script)
 
 
+class CopyEngine:
+    """ dir_in配下のファイルを、相対パスを保ったままdir_outに複数スレッドでコピーする。
+    ・Linuxではcopy_file_range (使えなければsendfile)で、ユーザー空間を経由せずにカーネル内でコピーする。
+    ・出力先のフォルダは一回だけ作る。(作成済みのフォルダはスレッド間で共有するセットに記録する)
+    ・ファイル毎のエラーは記録して、残りのファイルのコピーを続ける。
+    ・最後にファイル数、バイト数、スループットを表示する。
+
+    同期モード(sync)を指定すると、出力先が最新のファイルはコピーしない。
+        'size_mtime': サイズと更新日時が同じならコピーしない。(copystatで更新日時もコピーするので、二回目以降は一致する)
+        'content': サイズが同じ場合は内容を比べて、同じならコピーしない。
+    dry_run=True の場合はコピーせずに、予定(new: 出力先に無い、update: 出力先と違う)を表示するだけ。"""
+
+    # copy_file_range/sendfile一回あたりのバイト数
+    CHUNK_SIZE = 64 * 1024 * 1024
+    # カーネル内コピーが使えない場合のエラー。この場合は通常の読み書きでコピーする。
+    FALLBACK_ERRNO = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                      errno.ENOTSOCK, errno.EBADF}
+    SYNC_MODES = ['size_mtime', 'content']
+    # 更新日時の比較で許容する差(秒)。FATなど、更新日時の精度が粗い出力先では2にする。
+    MTIME_WINDOW = 0.0
+
+    def __init__(self, dir_in, dir_out, workers=4, sync=None, dry_run=False):
+        """
+        Constructor
+        :param dir_in: source root folder
+        :param dir_out: destination root folder
+        :param workers: thread count
+        :param sync: None (always copy) | 'size_mtime' | 'content'
+        :param dry_run: True = show planned actions without copying
+        """
+        if sync is not None and sync not in CopyEngine.SYNC_MODES:
+            raise ValueError(f'ERROR: {sync} is not a valid sync mode!')
+        self.dir_in = dir_in
+        self.dir_out = dir_out
+        self.workers = workers
+        self.sync = sync
+        self.dry_run = dry_run
+        self.files = 0
+        self.bytes = 0
+        self.actions = Counter()
+        self.skipped = 0
+        self.errors = []
+        self.seconds = 0.0
+        # 作成済みのフォルダの記録とmkdirの集計 (このコピーの間だけ)
+        self.dirs = DirMaker()
+
+    def __repr__(self):
+        return (f'CopyEngine({self.dir_in!r}, {self.dir_out!r}, workers={self.workers}, '
+                f'sync={self.sync!r}, dry_run={self.dry_run})')
+
+    @staticmethod
+    def same_content(src, dst):
+        # 二つのファイルの内容が同じか？ 違う部分が見つかった時点で読むのを止める。
+        with open(src, 'rb') as f_src, open(dst, 'rb') as f_dst:
+            while True:
+                data = f_src.read(1024 * 1024)
+                if data != f_dst.read(1024 * 1024):
+                    return False
+                if not data:
+                    return True
+
+    def plan(self, src, dst):
+        """
+        Decide what to do with a file
+        :return: 'copy' (sync無し) | 'new' | 'update' | None (出力先が最新なのでコピーしない)
+        """
+        if self.sync is None:
+            return 'copy'
+        try:
+            st_dst = os.stat(dst)
+        except FileNotFoundError:
+            return 'new'
+        st_src = os.stat(src)
+        if st_src.st_size != st_dst.st_size:
+            return 'update'
+        if self.sync == 'size_mtime':
+            same = abs(st_src.st_mtime - st_dst.st_mtime) <= CopyEngine.MTIME_WINDOW
+        else:
+            same = CopyEngine.same_content(src, dst)
+        return None if same else 'update'
+
+    @staticmethod
+    def _copy_range(fd_in, fd_out):
+        # カーネル内でコピーしてバイト数を返す。使えない場合はNone
+        for name in ('copy_file_range', 'sendfile'):
+            fnc = getattr(os, name, None)
+            if fnc is None:
+                continue
+            copied = 0
+            try:
+                while True:
+                    if name == 'sendfile':
+                        n = fnc(fd_out, fd_in, copied, CopyEngine.CHUNK_SIZE)
+                    else:
+                        n = fnc(fd_in, fd_out, CopyEngine.CHUNK_SIZE, copied, copied)
+                    if n == 0:
+                        return copied
+                    copied += n
+            except OSError as e:
+                # 途中まで書いた後のエラーは、本当のエラー(容量不足など)
+                if copied == 0 and e.errno in CopyEngine.FALLBACK_ERRNO:
+                    continue
+                raise
+        return None
+
+    @staticmethod
+    def copy_file(src, dst):
+        """
+        Copy a file and its metadata like shutil.copy2
+        :param src: source file
+        :param dst: destination file
+        :return: copied bytes
+        """
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            copied = CopyEngine._copy_range(f_in.fileno(), f_out.fileno())
+            # Windowsなど、カーネル内コピーが使えない場合
+            if copied is None:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                copied = f_out.tell()
+        shutil.copystat(src, dst)
+        return copied
+
+    def _copy_one(self, fp_in):
+        # 別スレッドで実行する。(ファイルパス, 処理, バイト数, エラー)を返す。
+        action = None
+        try:
+            rp = PathRelative(self.dir_in, fp_in, self.dir_out)
+            action = self.plan(rp.abs_src, rp.abs_dst)
+            if action is None:
+                return fp_in, None, 0, None
+            if self.dry_run:
+                return fp_in, action, os.path.getsize(rp.abs_src), None
+            # 作成済みのフォルダはself.dirsが覚えているので、makedirsは呼ばない。
+            if rp.rel_src_parent:
+                self.dirs.make(rp.abs_dst_parent)
+            return fp_in, action, CopyEngine.copy_file(rp.abs_src, rp.abs_dst), None
+        except OSError as e:
+            return fp_in, action, 0, e
+
+    def run(self, fp_gen):
+        """
+        Copy files
+        :param fp_gen: generator of files under dir_in
+        :return: self
+        """
+        t0 = time.perf_counter()
+        self.dirs.reset()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        it = iter(fp_gen)
+        pending = set()
+        max_pending = self.workers * 4
+        # コピーの順番は問わないので、終わった順に集計する。集計は呼び出し側のスレッドだけで行う。
+        try:
+            while True:
+                for fp_in in islice(it, max_pending - len(pending)):
+                    pending.add(executor.submit(self._copy_one, fp_in))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fp_in, action, size, err = future.result()
+                    if err is not None:
+                        self.errors.append((fp_in, err))
+                    elif action is None:
+                        self.skipped += 1
+                    else:
+                        self.files += 1
+                        self.bytes += size
+                        self.actions[action] += 1
+                        if self.dry_run:
+                            print(f'PLAN: {action:<6} {fp_in}')
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.seconds = time.perf_counter() - t0
+        return self
+
+    def report(self):
+        sec = max(self.seconds, 1e-9)
+        title = 'Copy Plan (dry run)' if self.dry_run else 'Copy Result'
+        print(f"""=== {title} ===
+Files       : {self.files:>16,}
+Bytes       : {self.bytes:>16,}
+Seconds     : {self.seconds:>16.2f}
+MB/s        : {self.bytes / sec / 1024 ** 2:>16.1f}
+Files/s     : {self.files / sec:>16.1f}
+Errors      : {len(self.errors):>16,}""")
+        # 同期モードの内訳
+        if self.sync is not None:
+            print(f"""New         : {self.actions['new']:>16,}
+Updated     : {self.actions['update']:>16,}
+Up to date  : {self.skipped:>16,}""")
+        self.dirs.report()
+        for fp_in, err in self.errors:
+            print(f'ERROR: {fp_in}\n\t{err}')
+
+
 class Copy:
     @staticmethod
-    def copy_files_by_regex(dir_in, dir_out):
+    def copy_files_by_regex(dir_in, dir_out, workers=1, prune=None, copy_workers=4, sync=None, dry_run=False):
         # ユーザー入力
         pattern = Prompt('Regular Expression: ').get_regex_i()
 
-        for fp_in in Filter.by_regex(dir_in, pattern=pattern, search_type='file', recursive=True):
-            PathRelative(dir_in, fp_in, dir_out).make_dirs_and_copy()
+        # コピーの順番は問わないので、並列時は列挙が終わった順に処理する。
+        fp_gen = Filter.by_regex(dir_in, pattern=pattern, search_type='file', recursive=True,
+                                 workers=workers, ordered=False, prune=prune)
+        CopyEngine(dir_in, dir_out, workers=copy_workers, sync=sync, dry_run=dry_run).run(fp_gen).report()
 
     @staticmethod
-    def copy_files_by_modified_timestamp(dir_in, dir_out):
+    def copy_files_by_modified_timestamp(dir_in, dir_out, workers=1, prune=None, copy_workers=4, sync=None,
+                                         dry_run=False):
         # ユーザー入力
         dt_lmt = Prompt('File Modified Timestamp: ').get_dt().timestamp()
 
-        for fp_in in Filter.by_modified_time(dir_in, ts_min=dt_lmt):
-            PathRelative(dir_in, fp_in, dir_out).make_dirs_and_copy()
+        fp_gen = Filter.by_modified_time(dir_in, ts_min=dt_lmt, workers=workers, ordered=False, prune=prune)
+        CopyEngine(dir_in, dir_out, workers=copy_workers, sync=sync, dry_run=dry_run).run(fp_gen).report()
+
+
+class DeleteEngine:
+    """ 二段階で削除する。
+    1. collect(): 削除対象を集める。対象のフォルダの中には入らないので、これから消す配下を辿らない。
+        フォルダへのシンボリックリンクは、リンク先ではなくリンク自体を削除する。
+    2. run(): スレッドで並列に削除する。
+        Linux等ではフォルダのファイル記述子(dir_fd)を基準にunlink/rmdirするので、パスの解決を繰り返さない。
+        ファイルは親フォルダ毎にまとめて、一つのdir_fdで削除する。
+    dry_run=True の場合は削除せずに、対象とサイズを表示するだけ。
+    エラーは記録して、残りの削除を続ける。最後に解放したバイト数とエラーの内訳を表示する。"""
+
+    # dir_fdを使えるか？ (Windowsでは使えないので、パスで削除する)
+    USE_FD = (os.unlink in os.supports_dir_fd and os.rmdir in os.supports_dir_fd
+              and os.open in os.supports_dir_fd and os.scandir in os.supports_fd)
+    # 表示するエラーの上限
+    MAX_ERRORS_SHOWN = 20
+
+    def __init__(self, workers=4, dry_run=False, prune=None):
+        """
+        Constructor
+        :param workers: thread count
+        :param dry_run: True = show targets without deleting
+        :param prune: Prune to skip excluded sub folders while collecting
+        """
+        self.workers = workers
+        self.dry_run = dry_run
+        self.prune = prune
+        self.targets = []
+        self.deleted = 0
+        self.bytes = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f'DeleteEngine(workers={self.workers}, dry_run={self.dry_run}, targets={len(self.targets)})'
+
+    def collect(self, dir_in, match):
+        """
+        Collect targets. Matched folders are not descended.
+        :param dir_in: root folder
+        :param match: function that takes an Entry and returns True if it is a target
+        :return: self
+        """
+        stack = [(dir_in, 0)]
+        while stack:
+            root, depth = stack.pop()
+            matched, sub_dirs = Mapper._list_dir(root, 'all', True, prune=self.prune, depth=depth)
+            found = set()
+            for entry in matched:
+                if match(entry):
+                    # フォルダへのシンボリックリンクはリンク先に入らず、リンク自体を一件として削除する。(サイズはlstat)
+                    if entry.is_dir() and entry.is_symlink():
+                        entry = Entry(entry.path, False, True)
+                    self.targets.append(entry)
+                    found.add(entry.path)
+            stack.extend((p, depth + 1) for p in reversed(sub_dirs) if p not in found)
+        return self
+
+    @staticmethod
+    def tree_size(path):
+        # フォルダ配下のファイルサイズの合計 (dry run用)
+        total = 0
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for de in it:
+                        if de.is_dir(follow_symlinks=False):
+                            stack.append(de.path)
+                        else:
+                            total += de.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+        return total
+
+    @staticmethod
+    def _rmtree_at(parent_fd, name, path, errors):
+        # parent_fdを基準に、フォルダnameの中身を消してからフォルダ自体を消す。解放したバイト数を返す。
+        # 途中で失敗してもエラーを記録して続け、それまでに解放したバイト数を返す。(親の合計から漏れないように)
+        freed = 0
+        fd = os.open(name, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0),
+                     dir_fd=parent_fd)
+        try:
+            with os.scandir(fd) as it:
+                entries = list(it)
+            for de in entries:
+                try:
+                    if de.is_dir(follow_symlinks=False):
+                        freed += DeleteEngine._rmtree_at(fd, de.name, os.path.join(path, de.name), errors)
+                    else:
+                        size = de.stat(follow_symlinks=False).st_size
+                        os.unlink(de.name, dir_fd=fd)
+                        freed += size
+                except OSError as e:
+                    errors.append((os.path.join(path, de.name), e))
+        finally:
+            os.close(fd)
+        try:
+            os.rmdir(name, dir_fd=parent_fd)
+        except OSError as e:
+            errors.append((path, e))
+        return freed
+
+    @staticmethod
+    def _rmtree_path(path, errors):
+        # dir_fdが使えない場合。解放したバイト数は、削除の前後の差にする。(一部が残った場合も正しい)
+        size = DeleteEngine.tree_size(path)
+
+        def on_error(fnc, p, exc):
+            errors.append((p, exc if isinstance(exc, BaseException) else exc[1]))
+
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(path, onexc=on_error)
+        else:
+            shutil.rmtree(path, onerror=on_error)
+        if os.path.lexists(path):
+            return size - DeleteEngine.tree_size(path)
+        return size
+
+    def _delete_dir(self, entry):
+        # 別スレッドで実行する。(パス, 解放したバイト数, 削除できた数(0 or 1), エラーのリスト)を返す。
+        errors = []
+        freed = 0
+        try:
+            if DeleteEngine.USE_FD:
+                parent_fd = os.open(os.path.dirname(entry.path), os.O_RDONLY)
+                try:
+                    freed = DeleteEngine._rmtree_at(parent_fd, entry.name, entry.path, errors)
+                finally:
+                    os.close(parent_fd)
+            else:
+                freed = DeleteEngine._rmtree_path(entry.path, errors)
+        except OSError as e:
+            errors.append((entry.path, e))
+        return entry.path, freed, int(not os.path.lexists(entry.path)), errors
+
+    def _delete_files(self, dir_parent, entries):
+        # 別スレッドで実行する。同じフォルダのファイルをまとめて削除する。戻り値は_delete_dir()と同じ。
+        errors = []
+        freed = 0
+        deleted = 0
+        parent_fd = os.open(dir_parent, os.O_RDONLY) if DeleteEngine.USE_FD else None
+        try:
+            for entry in entries:
+                try:
+                    size = os.lstat(entry.path).st_size
+                    if parent_fd is None:
+                        os.unlink(entry.path)
+                    else:
+                        os.unlink(entry.name, dir_fd=parent_fd)
+                    freed += size
+                    deleted += 1
+                except OSError as e:
+                    errors.append((entry.path, e))
+        finally:
+            if parent_fd is not None:
+                os.close(parent_fd)
+        return dir_parent, freed, deleted, errors
+
+    def run(self):
+        """
+        Delete the collected targets (or show them if dry_run)
+        :return: self
+        """
+        t0 = time.perf_counter()
+        dirs = [e for e in self.targets if e.is_dir()]
+        files = {}
+        for entry in self.targets:
+            if not entry.is_dir():
+                files.setdefault(os.path.dirname(entry.path), []).append(entry)
+
+        if self.dry_run:
+            for entry in dirs:
+                size = DeleteEngine.tree_size(entry.path)
+                self.bytes += size
+                print(f'PLAN: delete folder {entry.path} ({size:,} bytes)')
+            for entries in files.values():
+                for entry in entries:
+                    try:
+                        size = os.lstat(entry.path).st_size
+                    except OSError as e:
+                        self.errors.append((entry.path, e))
+                        continue
+                    self.bytes += size
+                    print(f'PLAN: delete file   {entry.path} ({size:,} bytes)')
+            self.seconds = time.perf_counter() - t0
+            return self
+
+        # 削除の順番は問わないので、終わった順に集計する。集計は呼び出し側のスレッドだけで行う。
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._delete_dir, e): True for e in dirs}
+            futures.update({executor.submit(self._delete_files, d, entries): False for d, entries in files.items()})
+            for future in as_completed(futures):
+                path, freed, deleted, errors = future.result()
+                self.bytes += freed
+                self.deleted += deleted
+                self.errors.extend(errors)
+                if futures[future] and deleted:
+                    print(f'Deleted {path}.')
+        self.seconds = time.perf_counter() - t0
+        return self
+
+    def report(self):
+        title = 'Delete Plan (dry run)' if self.dry_run else 'Delete Result'
+        print(f"""=== {title} ===
+Targets     : {len(self.targets):>16,}
+Deleted     : {self.deleted:>16,}
+Bytes freed : {self.bytes:>16,}
+Seconds     : {self.seconds:>16.2f}
+Errors      : {len(self.errors):>16,}""")
+        # エラーの種類毎の件数と、最初の数件
+        kinds = Counter(type(e).__name__ if e.strerror is None else e.strerror for _, e in self.errors)
+        for kind, count in kinds.most_common():
+            print(f'\t{kind}: {count:,}')
+        for path, e in self.errors[:DeleteEngine.MAX_ERRORS_SHOWN]:
+            print(f'ERROR: {path}\n\t{e}')
+        if len(self.errors) > DeleteEngine.MAX_ERRORS_SHOWN:
+            print(f'... {len(self.errors) - DeleteEngine.MAX_ERRORS_SHOWN:,} more errors')
 
 
 class Delete:
     @staticmethod
-    def delete_pycache(dir_in):
-        for dir_sub in Filter.by_base_name(dir_in, base_name='__pycache__', search_type='dir', recursive=True):
-            shutil.rmtree(dir_sub)
-            print(f'Deleted {dir_sub}.')
+    def delete_pycache(dir_in, prune=None, workers=4, dry_run=False):
+        engine = DeleteEngine(workers=workers, dry_run=dry_run, prune=prune)
+        engine.collect(dir_in, lambda e: e.is_dir() and e.name.upper() == '__PYCACHE__')
+        engine.run().report()
 
     @staticmethod
-    def delete_folders_by_base_name(dir_in):
-        base_name = input('Folder Name to be : ')
-        for dir_sub in Filter.by_base_name(dir_in, base_name=base_name, search_type='dir', recursive=True):
-            shutil.rmtree(dir_sub)
-            print(f'Deleted {dir_sub}.')
+    def delete_folders_by_base_name(dir_in, prune=None, workers=4, dry_run=False):
+        base_name = input('Folder Name to be : ').upper()
+        engine = DeleteEngine(workers=workers, dry_run=dry_run, prune=prune)
+        engine.collect(dir_in, lambda e: e.is_dir() and e.name.upper() == base_name)
+        engine.run().report()
 
     @staticmethod
-    def delete_files_by_regex(dir_in):
+    def delete_files_by_regex(dir_in, prune=None, workers=4, dry_run=False):
         pattern = Prompt('Regular expression to filter files: ').get_regex_i()
-        for fp in Filter.by_regex(dir_in, pattern=pattern, search_type='file', recursive=True):
-            try:
-                os.remove(fp)
-            except FileNotFoundError as e:
-                print(e)
+        engine = DeleteEngine(workers=workers, dry_run=dry_run, prune=prune)
+        engine.collect(dir_in, lambda e: e.is_file() and pattern.match(e.path))
+        engine.run().report()
+
+
+class DiskUsage:
+    """ フォルダ配下のディスク使用量を集計する。
+    ・サイズはscandirのstatキャッシュから取得し、サブフォルダはスレッドで並列に辿る。(Mapper)
+    ・フォルダ毎の合計(配下全体)は、dir_inからdepthまでの深さのフォルダだけ持つ。
+    ・最大のファイルはtop_n件のヒープで持つ。拡張子毎の件数とサイズも集計する。
+    よって、メモリは全体の件数ではなく、depthまでのフォルダ数、top_n、拡張子の種類数で決まる。"""
+
+    def __init__(self, dir_in, top_n=20, depth=1):
+        """
+        Constructor
+        :param dir_in: root folder
+        :param top_n: number of the largest files/folders to keep
+        :param depth: folders up to this depth get their own totals (1 = direct sub folders of dir_in)
+        """
+        self.dir_in = os.path.normpath(os.path.abspath(dir_in))
+        self.top_n = top_n
+        self.depth = depth
+        self.file_count = 0
+        self.dir_count = 0
+        self.total = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # 相対パス -> [バイト数, ファイル数] ('.'はdir_in直下のファイル)
+        self.dirs = {}
+        # 拡張子(小文字) -> [ファイル数, バイト数]
+        self.extensions = {}
+        # (サイズ, パス)の最小ヒープ。先頭がtop_n件の中で一番小さい。
+        self.top_files = []
+
+    def __repr__(self):
+        return f'DiskUsage({self.dir_in!r}, top_n={self.top_n}, depth={self.depth})'
+
+    def add(self, entry):
+        # 一件分を集計する。
+        if entry.is_dir():
+            self.dir_count += 1
+            return
+        try:
+            size = entry.size
+        except OSError:
+            self.errors += 1
+            return
+        self.file_count += 1
+        self.total += size
+
+        ext = os.path.splitext(entry.name)[1].lower()
+        stats = self.extensions.get(ext)
+        if stats is None:
+            stats = self.extensions[ext] = [0, 0]
+        stats[0] += 1
+        stats[1] += size
+
+        if self.top_n > 0:
+            if len(self.top_files) < self.top_n:
+                heapq.heappush(self.top_files, (size, entry.path))
+            elif size > self.top_files[0][0]:
+                heapq.heapreplace(self.top_files, (size, entry.path))
+
+        # depthまでの親フォルダに加算する。
+        if self.depth > 0:
+            parts = entry.path[len(self.dir_in) + 1:].split(os.sep)[:-1]
+            keys = [os.sep.join(parts[:k]) for k in range(1, min(self.depth, len(parts)) + 1)] or ['.']
+            for key in keys:
+                stats = self.dirs.get(key)
+                if stats is None:
+                    stats = self.dirs[key] = [0, 0]
+                stats[0] += size
+                stats[1] += 1
+
+    def scan(self, workers=1, prune=None):
+        """
+        Walk dir_in and aggregate
+        :param workers: thread count to list folders
+        :param prune: Prune
+        :return: self
+        """
+        t0 = time.perf_counter()
+        # 集計なので順番は問わない。statは並列時はワーカー側で済ませる。
+        mapper = Mapper(self.dir_in, workers=workers, ordered=False, prune=prune)
+        for entry in mapper.entry_generator(search_type='all', recursive=True, prefetch_stat=True):
+            self.add(entry)
+        self.seconds = time.perf_counter() - t0
+        return self
+
+    def largest_files(self):
+        # [(サイズ, パス)] 大きい順
+        return sorted(self.top_files, reverse=True)
+
+    def largest_dirs(self):
+        # [(サイズ, ファイル数, 相対パス)] 大きい順
+        return heapq.nlargest(self.top_n, ((v[0], v[1], k) for k, v in self.dirs.items()))
+
+    def largest_extensions(self):
+        # [(サイズ, ファイル数, 拡張子)] 大きい順
+        return heapq.nlargest(self.top_n, ((v[1], v[0], k) for k, v in self.extensions.items()))
+
+    def report(self):
+        sec = max(self.seconds, 1e-9)
+        print(f"""=== Result ===
+File Count  : {self.file_count:>16,}
+File Size   : {self.total:>16,}
+Folder Count: {self.dir_count:>16,}
+Seconds     : {self.seconds:>16.2f}
+Entries/s   : {(self.file_count + self.dir_count) / sec:>16.1f}
+Errors      : {self.errors:>16,}""")
+        print(f'=== Largest Folders (depth <= {self.depth}) ===')
+        for size, count, rel in self.largest_dirs():
+            print(f'{size:>16,} {count:>10,} files  {rel}')
+        print('=== Largest Files ===')
+        for size, path in self.largest_files():
+            print(f'{size:>16,}  {path}')
+        print('=== Extensions ===')
+        for size, count, ext in self.largest_extensions():
+            print(f'{size:>16,} {count:>10,} files  {ext or "(none)"}')
 
 
 class Count:
     @staticmethod
-    def count_files(dir_in):
-
-        file_count = 0
-        dir_count = 0
-        file_size = 0
+    def count_files(dir_in, workers=1, prune=None):
+        # ファイルサイズはscandirのstatキャッシュから取得する。
+        usage = DiskUsage(dir_in, top_n=0, depth=0)
         if os.path.isdir(dir_in):
-            for root, dirs, files in os.walk(dir_in):
-                for file in files:
-                    file_count += 1
-                    file_size += os.path.getsize(os.path.join(root, file))
-                for _dir in dirs:
-                    dir_count += 1
-                    # ">16" means 16 space padding on the left
-                    # "," means thousand separator
+            usage.scan(workers=workers, prune=prune)
+        # ">16" means 16 space padding on the left
+        # "," means thousand separator
         print(f"""=== Result ===
-File Count  : {file_count:>16,}
-File Size   : {file_size:>16,}
-Folder Count: {dir_count:>16,}""")
+File Count  : {usage.file_count:>16,}
+File Size   : {usage.total:>16,}
+Folder Count: {usage.dir_count:>16,}""")
+
+    @staticmethod
+    def disk_usage(dir_in, workers=1, prune=None, top_n=20, depth=1):
+        """
+        Disk usage with per-folder, per-extension totals and the largest files/folders
+        :return: DiskUsage
+        """
+        usage = DiskUsage(dir_in, top_n=top_n, depth=depth).scan(workers=workers, prune=prune)
+        usage.report()
+        return usage
+
+
+class Duplicate:
+    """ 内容が同じファイルを探す。
+    1. サイズでまとめる。(scandirのstatキャッシュ、読み込み無し)
+    2. サイズが同じファイルだけ、先頭と末尾のブロックのハッシュでまとめる。
+    3. それでも同じファイルだけ、全体のハッシュでまとめる。
+    読み込むバイト数は全体の大きさではなく、衝突した候補の数で決まる。ハッシュはスレッドで並列に計算する。"""
+
+    # 先頭・末尾それぞれのバイト数。ファイルが2ブロック以下ならば、部分ハッシュで全体を読んだことになる。
+    BLOCK_SIZE = 64 * 1024
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, dir_in, workers=4, min_size=1, prune=None):
+        """
+        Constructor
+        :param dir_in: root folder
+        :param workers: thread count to list folders and to hash files
+        :param min_size: files smaller than this are ignored (0 byte files are all the same)
+        :param prune: Prune
+        """
+        self.dir_in = dir_in
+        self.workers = max(1, workers)
+        self.min_size = min_size
+        self.prune = prune
+        self.file_count = 0
+        self.partial_count = 0
+        self.full_count = 0
+        self.bytes_read = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # [(サイズ, [パス])] 見つかった重複のグループ
+        self.groups = []
+
+    def __repr__(self):
+        return f'Duplicate({self.dir_in!r}, workers={self.workers}, min_size={self.min_size})'
+
+    @staticmethod
+    def partial_digest(fp, size):
+        # 先頭と末尾のブロックのハッシュ。別スレッドから呼ばれる。
+        h = hashlib.blake2b(digest_size=16)
+        with open(fp, 'rb') as f:
+            if size <= Duplicate.BLOCK_SIZE * 2:
+                h.update(f.read())
+            else:
+                h.update(f.read(Duplicate.BLOCK_SIZE))
+                f.seek(size - Duplicate.BLOCK_SIZE)
+                h.update(f.read(Duplicate.BLOCK_SIZE))
+        return h.digest()
+
+    @staticmethod
+    def full_digest(fp):
+        # 全体のハッシュ。別スレッドから呼ばれる。
+        h = hashlib.blake2b(digest_size=32)
+        with open(fp, 'rb') as f:
+            for data in iter(partial(f.read, Duplicate.CHUNK_SIZE), b''):
+                h.update(data)
+        return h.digest()
+
+    def _hash_groups(self, executor, groups, fnc):
+        """
+        Split each group by the hash of its files
+        :param groups: [(size, [path])]
+        :param fnc: fnc(path, size) -> digest
+        :return: [(size, [path])] with 2 files or more
+        """
+        def one(item):
+            size, fp = item
+            try:
+                return size, fp, fnc(fp, size)
+            except OSError:
+                return size, fp, None
+
+        items = ((size, fp) for size, fps in groups for fp in fps)
+        by_digest = {}
+        # mapは順番通りに返すので、結果は呼び出し元のスレッドで集計する。
+        for size, fp, digest in executor.map(one, items):
+            if digest is None:
+                self.errors += 1
+                continue
+            by_digest.setdefault((size, digest), []).append(fp)
+        return [(size, fps) for (size, _), fps in by_digest.items() if len(fps) > 1]
+
+    def scan(self):
+        """
+        Find duplicates
+        :return: self
+        """
+        t0 = time.perf_counter()
+        # 1. サイズ
+        by_size = {}
+        mapper = Mapper(self.dir_in, workers=self.workers, ordered=False, prune=self.prune)
+        for entry in mapper.entry_generator(search_type='file', recursive=True, prefetch_stat=True):
+            try:
+                size = entry.size
+            except OSError:
+                self.errors += 1
+                continue
+            self.file_count += 1
+            if size >= self.min_size:
+                by_size.setdefault(size, []).append(entry.path)
+        groups = [(size, fps) for size, fps in by_size.items() if len(fps) > 1]
+        del by_size
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # 2. 先頭と末尾
+            self.partial_count = sum(len(fps) for _, fps in groups)
+            self.bytes_read += sum(min(size, Duplicate.BLOCK_SIZE * 2) * len(fps) for size, fps in groups)
+            groups = self._hash_groups(executor, groups, Duplicate.partial_digest)
+
+            # 3. 全体 (部分ハッシュで全体を読んだグループは確定)
+            done = [g for g in groups if g[0] <= Duplicate.BLOCK_SIZE * 2]
+            rest = [g for g in groups if g[0] > Duplicate.BLOCK_SIZE * 2]
+            self.full_count = sum(len(fps) for _, fps in rest)
+            self.bytes_read += sum(size * len(fps) for size, fps in rest)
+            done += self._hash_groups(executor, rest, lambda fp, size: Duplicate.full_digest(fp))
+
+        # 無駄なバイト数の大きい順
+        self.groups = sorted(((size, sorted(fps)) for size, fps in done),
+                             key=lambda g: (-g[0] * (len(g[1]) - 1), g[1][0]))
+        self.seconds = time.perf_counter() - t0
+        return self
+
+    def wasted(self):
+        # 1つを残して消せば空くバイト数
+        return sum(size * (len(fps) - 1) for size, fps in self.groups)
+
+    def write_csv(self, fp_out):
+        # グループ番号, サイズ, パス
+        with open(fp_out, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['group', 'size', 'path'])
+            for i, (size, fps) in enumerate(self.groups, 1):
+                for fp in fps:
+                    writer.writerow([i, size, fp])
+
+    def report(self, max_groups=50):
+        for i, (size, fps) in enumerate(self.groups[:max_groups], 1):
+            print(f'=== Group {i}: {len(fps)} files x {size:,} bytes ===')
+            for fp in fps:
+                print(fp)
+        if len(self.groups) > max_groups:
+            print(f'INFO: {len(self.groups) - max_groups:,} more groups are not shown.')
+        print(f"""=== Duplicates ===
+File Count  : {self.file_count:>16,}
+Partial Hash: {self.partial_count:>16,}
+Full Hash   : {self.full_count:>16,}
+Bytes Read  : {self.bytes_read:>16,}
+Groups      : {len(self.groups):>16,}
+Duplicates  : {sum(len(fps) - 1 for _, fps in self.groups):>16,}
+Wasted Bytes: {self.wasted():>16,}
+Errors      : {self.errors:>16,}
+Seconds     : {self.seconds:>16.2f}""")
+
+
+class Prefilter:
+    """ 正規表現から、全てのマッチに必ず含まれる文字列(リテラル)を取り出しておき、
+    正規表現を実行する前に、高速な部分文字列検索(find/in)で候補を絞る。
+        ・リテラルを含まないファイル(チャンク)は正規表現を実行せずに飛ばす。
+        ・改行をまたいでマッチしない正規表現の場合は、リテラルを含む行だけを正規表現で検索する。
+    結果は正規表現だけで検索した場合と同じになる。"""
+    # 1文字のリテラルでは絞り込みの効果が薄い。
+    MIN_LENGTH = 2
+    # 行単位の検索で、候補の行の平均間隔(文字数)がこれより短い場合は、残りを通常の検索に切り替える。
+    DENSE_GAP = 4096
+
+    def __init__(self, ptn):
+        """
+        Constructor
+        :param ptn: compiled regular expression (str or bytes)
+        """
+        self.literal = None
+        self.by_line = False
+        try:
+            parsed = sre_parse.parse(ptn.pattern, ptn.flags)
+        except Exception:
+            return
+        # 大文字小文字を区別しない場合は、単純な部分文字列検索が使えない。
+        flags = parsed.state.flags
+        if flags & re.IGNORECASE:
+            return
+
+        runs = Prefilter._literal_runs(parsed)
+        if not runs:
+            return
+        run = max(runs, key=len)
+        if len(run) < Prefilter.MIN_LENGTH:
+            return
+        # 正規表現がリテラルで始まる場合は、reモジュール自体が同じ高速検索をするので不要。
+        if parsed[0][0] == sre_parse.LITERAL and runs[0] is run:
+            return
+        if isinstance(ptn.pattern, bytes):
+            self.literal = bytes(run)
+            self.newline = b'\n'
+        else:
+            self.literal = ''.join(map(chr, run))
+            self.newline = '\n'
+        self.by_line = Prefilter._is_line_local(parsed, bool(flags & re.DOTALL))
+
+    def __repr__(self):
+        return f'Prefilter(literal={self.literal!r}, by_line={self.by_line})'
+
+    @staticmethod
+    def _literal_runs(parsed):
+        # 必ずマッチに含まれる、連続したリテラル文字のリスト(文字コードのリスト)を返す。
+        runs = []
+        cur = []
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                cur.append(av)
+                continue
+            if cur:
+                runs.append(cur)
+                cur = []
+            # グループの中身も必須。ただし、グループ内で大文字小文字を無視する場合は除く。
+            if op == sre_parse.SUBPATTERN:
+                group, add_flags, del_flags, p = av
+                if not add_flags & re.IGNORECASE:
+                    runs.extend(Prefilter._literal_runs(p))
+            elif hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+                runs.extend(Prefilter._literal_runs(av))
+            # 1回以上の繰り返しなら、中身は必須。
+            elif op in Prefilter._repeats() and av[0] >= 1:
+                runs.extend(Prefilter._literal_runs(av[2]))
+            # 分岐(|)やその他は、必須の文字列とは言えないので区切るだけ。
+        if cur:
+            runs.append(cur)
+        return runs
+
+    @staticmethod
+    def _repeats():
+        ops = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT]
+        if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+            ops.append(sre_parse.POSSESSIVE_REPEAT)
+        return ops
+
+    @staticmethod
+    def _is_line_local(parsed, dotall):
+        # 改行をまたいでマッチしないか？ アンカー、先読み・後読み、後方参照を含む場合は判断しない(False)。
+        newline = ord('\n')
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                if av == newline:
+                    return False
+            elif op == sre_parse.NOT_LITERAL:
+                if av != newline:
+                    return False
+            elif op == sre_parse.ANY:
+                if dotall:
+                    return False
+            elif op == sre_parse.IN:
+                if not Prefilter._set_is_line_local(av):
+                    return False
+            elif op == sre_parse.SUBPATTERN:
+                group, add_flags, del_flags, p = av
+                sub_dotall = (dotall or bool(add_flags & re.DOTALL)) and not del_flags & re.DOTALL
+                if not Prefilter._is_line_local(p, sub_dotall):
+                    return False
+            elif op in Prefilter._repeats():
+                if not Prefilter._is_line_local(av[2], dotall):
+                    return False
+            elif op == sre_parse.BRANCH:
+                for p in av[1]:
+                    if not Prefilter._is_line_local(p, dotall):
+                        return False
+            elif hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+                if not Prefilter._is_line_local(av, dotall):
+                    return False
+            else:
+                return False
+        return True
+
+    @staticmethod
+    def _set_is_line_local(items):
+        # 文字クラス[...]が改行にマッチしないか？
+        newline = ord('\n')
+        for op, av in items:
+            if op == sre_parse.NEGATE:
+                return False
+            elif op == sre_parse.LITERAL:
+                if av == newline:
+                    return False
+            elif op == sre_parse.RANGE:
+                if av[0] <= newline <= av[1]:
+                    return False
+            elif op == sre_parse.CATEGORY:
+                if av not in (sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_WORD, sre_parse.CATEGORY_NOT_SPACE):
+                    return False
+            else:
+                return False
+        return True
+
+    def may_match(self, data):
+        # リテラルを含まなければ、正規表現は絶対にマッチしない。
+        return self.literal is None or data.find(self.literal) != -1
+
+    def finditer(self, ptn, data):
+        """
+        Same as ptn.finditer(data), but runs the regex only where it can match
+        :param ptn: compiled regular expression this Prefilter was made from
+        :param data: str, bytes or mmap
+        """
+        if self.literal is None:
+            yield from ptn.finditer(data)
+            return
+        pos = data.find(self.literal)
+        if pos == -1:
+            return
+        if not self.by_line:
+            yield from ptn.finditer(data)
+            return
+
+        # リテラルを含む行だけを検索する。
+        end = len(data)
+        first = pos
+        count = 0
+        while pos != -1:
+            line_start = data.rfind(self.newline, 0, pos) + 1
+            line_end = data.find(self.newline, pos)
+            if line_end == -1:
+                line_end = end
+            yield from ptn.finditer(data, line_start, line_end)
+            # 候補が密集している場合は、行毎に区切る方が遅いので、残りは普通に検索する。
+            # (改行をまたぐマッチは無いので、行頭から検索を再開しても結果は同じ)
+            count += 1
+            if count % 64 == 0 and (line_end - first) < count * self.DENSE_GAP:
+                yield from ptn.finditer(data, line_end)
+                return
+            pos = data.find(self.literal, line_end)
+
+
+class GrepWriter:
+    """ Grepの結果を見つけた順にファイルへ書き出す。結果をメモリに溜めない。
+    chunk_size件毎にまとめて書き出すので、一件ずつ書くよりも速い。
+    グループ無し: grep.txt (一行に一件)
+    グループ有り: grep.csv (DataFrame.to_csv()と同じ形式。先頭列はインデックス)"""
+    CHUNK_SIZE = 10000
+
+    def __init__(self, dir_out, groups, columns=None, chunk_size=None, name='grep'):
+        """
+        Constructor
+        :param dir_out: 出力フォルダ
+        :param groups: 正規表現のグループ数
+        :param columns: グループ有りの場合の列名
+        :param chunk_size: まとめて書き出す件数
+        :param name: 出力ファイル名(拡張子無し)
+        """
+        self.groups = groups
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.name = name
+        self.rows = []
+        self.count = 0
+        self.written = 0
+        self.open(dir_out, columns)
+
+    def open(self, dir_out, columns):
+        if self.groups == 0:
+            self.fp_out = os.path.join(dir_out, f'{self.name}.txt')
+            self.f = open(self.fp_out, 'w')
+            self.writer = None
+        else:
+            self.fp_out = os.path.join(dir_out, f'{self.name}.csv')
+            self.f = open(self.fp_out, 'w', encoding='utf-8', newline='')
+            self.writer = csv.writer(self.f, lineterminator=os.linesep)
+            self.writer.writerow([''] + list(columns))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, value):
+        # value: findall()と同じ形式。グループが一つの場合は文字列、二つ以上の場合はタプル。
+        self.rows.append(value)
+        self.count += 1
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            # '\n'.join()と同じく、最後の行には改行を付けない。
+            if self.written:
+                self.f.write('\n')
+            self.f.write('\n'.join(self.rows))
+        elif self.groups == 1:
+            self.writer.writerows([i, v] for i, v in enumerate(self.rows, self.written))
+        else:
+            self.writer.writerows([i, *v] for i, v in enumerate(self.rows, self.written))
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+            print(f'Created {self.fp_out}.')
+
+
+class GrepTableWriter(GrepWriter):
+    """ Grepの結果を列の型付きでParquetもしくはFeather(Arrow IPC)に書き出す。(pyarrowが必要)
+    chunk_size件毎に一つのRow Group(Record Batch)として追記するので、メモリ使用量は一定。
+    列の型は str, int, hex (0x1Fなど16進数の文字列を整数にする), float。
+    型を指定しない場合は、最初のチャンクから推定する。変換できない値はNull(欠損値)になる。
+    列の型は最初のRow Groupで確定し、後から変えられない。Nullにした値の件数は列毎に数え、close()で表示する。"""
+    TYPES = ['str', 'int', 'hex', 'float']
+    FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+    INT_PTN = re.compile(r'[-+]?\d+')
+    HEX_PTN = re.compile(r'0[xX][0-9a-fA-F]+')
+    FLOAT_PTN = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+    def __init__(self, dir_out, groups, columns=None, chunk_size=None, name='grep', fmt='parquet', dtypes=None):
+        """
+        Constructor
+        :param fmt: 'parquet' | 'feather'
+        :param dtypes: list of column types in TYPES (None = infer from the first chunk)
+        """
+        if pa is None:
+            raise ImportError('ERROR: pyarrow is required to write Parquet/Feather files!')
+        self.fmt = fmt
+        self.dtypes = dtypes
+        super().__init__(dir_out, groups, columns, chunk_size, name)
+
+    def open(self, dir_out, columns):
+        # グループ無しの場合は、マッチした文字列の一列だけ。
+        self.columns = list(columns) if columns else ['match']
+        self.fp_out = os.path.join(dir_out, self.name + self.FORMATS[self.fmt])
+        self.sink = None
+        self.closed = False
+        # 列毎の、変換できずにNullにした値(空文字以外)の件数
+        self.nulls = Counter()
+
+    @classmethod
+    def infer_type(cls, values):
+        # 空文字(マッチしなかったグループ)以外の全ての値が変換できる型を返す。
+        values = [v for v in values if v]
+        if not values:
+            return 'str'
+        for dtype, ptn in [('int', cls.INT_PTN), ('hex', cls.HEX_PTN), ('float', cls.FLOAT_PTN)]:
+            if all(ptn.fullmatch(v) for v in values):
+                return dtype
+        return 'str'
+
+    @staticmethod
+    def to_array(values, dtype):
+        if dtype == 'str':
+            return pa.array(values, type=pa.string())
+        elif dtype == 'float':
+            conv, arrow_type = float, pa.float64()
+        elif dtype == 'hex':
+            conv, arrow_type = partial(int, base=16), pa.int64()
+        elif dtype == 'int':
+            conv, arrow_type = int, pa.int64()
+        else:
+            raise ValueError(f'ERROR: {dtype} is not a valid column type!')
+
+        data = []
+        for v in values:
+            try:
+                x = conv(v)
+            except ValueError:
+                x = None
+            # int64に収まらない整数も欠損値にする。
+            if dtype != 'float' and x is not None and not -2 ** 63 <= x < 2 ** 63:
+                x = None
+            data.append(x)
+        return pa.array(data, type=arrow_type)
+
+    def flush(self):
+        if not self.rows:
+            return
+        # 行のリストを列のリストに変換する。
+        if self.groups <= 1:
+            cols = [self.rows]
+        else:
+            cols = [list(c) for c in zip(*self.rows)]
+        if self.dtypes is None:
+            self.dtypes = [self.infer_type(c) for c in cols]
+            print(f'INFO: Column types: {dict(zip(self.columns, self.dtypes))}')
+
+        arrays = [self.to_array(c, t) for c, t in zip(cols, self.dtypes)]
+        # 空文字(マッチしなかったグループ)以外でNullになった値を数える。(strの列はNullにならない)
+        for name, dtype, c, arr in zip(self.columns, self.dtypes, cols, arrays):
+            if dtype != 'str':
+                self.nulls[name] += arr.null_count - sum(1 for v in c if not v)
+        batch = pa.RecordBatch.from_arrays(arrays, names=self.columns)
+        if self.sink is None:
+            if self.fmt == 'parquet':
+                self.sink = pa.parquet.ParquetWriter(self.fp_out, batch.schema)
+            else:
+                self.sink = pa.ipc.new_file(self.fp_out, batch.schema)
+        if self.fmt == 'parquet':
+            self.sink.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.sink.write_batch(batch)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            # 結果が0件の場合は、列名と型だけのファイルを作る。
+            if self.sink is None:
+                dtypes = self.dtypes or ['str'] * len(self.columns)
+                batch = pa.RecordBatch.from_arrays([self.to_array([], t) for t in dtypes], names=self.columns)
+                if self.fmt == 'parquet':
+                    self.sink = pa.parquet.ParquetWriter(self.fp_out, batch.schema)
+                else:
+                    self.sink = pa.ipc.new_file(self.fp_out, batch.schema)
+            self.sink.close()
+            print(f'Created {self.fp_out}.')
+            for name, dtype in zip(self.columns, self.dtypes or []):
+                if self.nulls[name]:
+                    print(f"ERROR: {self.nulls[name]:,} values in column '{name}' did not fit {dtype} "
+                          f"and were written as Null. Use the 'str' type to keep them.")
 
 
 class Grep:
+    # ストリーミング時の読み込み単位(文字数)と、チャンク境界をまたぐマッチの為に持ち越す文字数
+    CHUNK_SIZE = 1024 * 1024
+    OVERLAP = 64 * 1024
+    # bytesのまま正規表現を実行しても、テキストの場合と結果が変わらないエンコーディング
+    # (ASCII互換で、マルチバイト文字の途中のバイトがASCIIの範囲と重ならないもの)
+    BYTES_ENCODINGS = {'ascii', 'utf-8', 'iso8859-1', 'cp1252'}
+
     @staticmethod
     def tip():
         # 新しいノウハウを学んだら、ここに書き込みたい。
@@ -739,13 +3327,19 @@ Typical Group Expressions
         elif os.path.isdir(path_in):
             # 正規表現でフィルタ
             ptn = Prompt('Regex to filter files: ').get_regex_i()
-            gen = Filter.by_regex(path_in=path_in, pattern=ptn)
+            gen = Filter.entries_by_regex(path_in=path_in, pattern=ptn)
             # ファイルタイムスタンプで並べ替え
             if Prompt('Sort by date?').get_yes_no():
-                gen = Sorter.sort_by_date_modified(gen)
+                # Entryのstatキャッシュで並べ替える。件数を絞る場合は、新しい順に上位だけをヒープで選ぶ。
+                limit = Prompt('Newest N files only, newest first (0 = all): ').get_int()
+                if limit > 0:
+                    yield from Sorter.sort_by_date_modified(gen, reverse=True, limit=limit)
+                else:
+                    yield from Sorter.sort_by_date_modified(gen)
             # 返す
-            for fp in gen:
-                yield fp
+            else:
+                for entry in gen:
+                    yield entry.path
         # 入力が不正の場合はNoneを返す。
         else:
             yield None
@@ -789,19 +3383,360 @@ Typical Group Expressions
         print(f'result: {sample}')
 
     @staticmethod
-    def grep(path_in, dir_out):
+    def match_value(m, groups):
+        # findall()と同じ形式の値を返す。
+        if groups == 0:
+            return m.group()
+        elif groups == 1:
+            return m.group(1) or ''
+        else:
+            return m.groups('')
+
+    @staticmethod
+    def iter_matches(ptn, text):
+        # findall()と同じ結果を、リストを作らずに一件ずつ返す。
+        groups = ptn.groups
+        for m in ptn.finditer(text):
+            yield Grep.match_value(m, groups)
+
+    @staticmethod
+    def iter_file_matches(fp, ptn, encoding, chunk_size=None, overlap=None, prefilter=None):
+        """
+        Search a file chunk by chunk
+        :param fp: file path
+        :param ptn: compiled regular expression
+        :param encoding: file encoding
+        :param chunk_size: characters to read at once
+        :param overlap: characters carried over to the next chunk
+            Matches longer than overlap may be missed at chunk boundaries.
+            '^', '\\A' and look-behind see the carried text as the beginning of the string.
+        :param prefilter: Prefilter made from ptn. Chunks without its literal are skipped.
+        :return: yield the same value as findall()
+        """
+        chunk_size = chunk_size or Grep.CHUNK_SIZE
+        overlap = overlap or Grep.OVERLAP
+        groups = ptn.groups
+        with open(fp, 'r', encoding=encoding, errors='ignore') as f:
+            buf = ''
+            while True:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf += chunk
+                # 確定できる範囲。EOF以外は、末尾のoverlap分は次のチャンクと繋げてから探し直す。
+                limit = len(buf) if eof else max(len(buf) - overlap, 0)
+                keep = limit
+                # リテラルを含まないチャンクには、確定範囲内のマッチは無い。
+                matches = ptn.finditer(buf) if prefilter is None or prefilter.may_match(buf) else []
+                for m in matches:
+                    # 確定範囲をはみ出すマッチは、次のチャンクで改めて探す。
+                    # limitより後から始まるマッチでも、limitから後ろは全て持ち越す。
+                    # (limitとマッチの間から始まり、次のチャンクまで続くマッチを落とさないため)
+                    if not eof and (m.start() >= limit or m.end() > limit):
+                        keep = min(m.start(), limit)
+                        break
+                    yield Grep.match_value(m, groups)
+                if eof:
+                    break
+                buf = buf[keep:]
+
+    @staticmethod
+    def to_bytes_pattern(ptn, encoding):
+        """
+        Compile the bytes version of a str pattern
+        :return: compiled bytes pattern, or None if the encoding/pattern cannot be used as bytes
+        """
+        name = codecs.lookup(encoding).name
+        if name not in Grep.BYTES_ENCODINGS:
+            print(f'ERROR: {encoding} is not supported in bytes mode. Use one of {sorted(Grep.BYTES_ENCODINGS)}.')
+            return None
+        # bytesの正規表現では \w \d \s \b やIGNORECASEはASCIIの範囲のみ対象になり、
+        # UTF-8では '.' や否定の文字クラスが1文字ではなく1バイトにマッチする。結果が変わる場合は使わない。
+        if name != 'ascii':
+            reason = Grep.bytes_unsafe(ptn, encoding, multi_byte=(name == 'utf-8'))
+            if reason is not None:
+                print(f'INFO: {reason} matches differently in bytes mode for {encoding}.')
+                return None
+        try:
+            return re.compile(ptn.pattern.encode(encoding), ptn.flags & ~re.UNICODE)
+        except (re.error, UnicodeEncodeError) as e:
+            print('ERROR: failed to compile bytes regular expression!')
+            print(e)
+            return None
+
+    @staticmethod
+    def bytes_unsafe(ptn, encoding, multi_byte):
+        """
+        Check if the bytes version of a str pattern may return different matches for non-ASCII text
+        :param ptn: compiled str regular expression
+        :param encoding: file encoding
+        :param multi_byte: True for UTF-8 (a character can be several bytes)
+        :return: the reason (str) or None if the results are the same
+        """
+        ascii_only = bool(ptn.flags & re.ASCII)
+        if ptn.flags & re.IGNORECASE and not ascii_only:
+            return 'IGNORECASE'
+        # bytesの構文木で調べる。(strの構文木では[é]が1文字に最適化され、バイト単位のクラスになることが分からない)
+        try:
+            parsed = sre_parse.parse(ptn.pattern.encode(encoding), ptn.flags & ~re.UNICODE)
+        except (re.error, UnicodeEncodeError):
+            return None
+        return Grep._bytes_unsafe(parsed, multi_byte, ascii_only)
+
+    @staticmethod
+    def _bytes_unsafe(parsed, multi_byte, ascii_only):
+        # 構文木を辿って、bytesにすると意味の変わる部分を探す。
+        for op, av in parsed:
+            if op in (sre_parse.ANY, sre_parse.NOT_LITERAL):
+                if multi_byte:
+                    return "'.' or [^x]"
+                subs = []
+            elif op == sre_parse.IN:
+                for in_op, in_av in av:
+                    if in_op == sre_parse.CATEGORY and not ascii_only:
+                        return r'\w \d \s'
+                    if multi_byte and in_op == sre_parse.NEGATE:
+                        return 'a negated character class'
+                    if multi_byte and in_op == sre_parse.LITERAL and in_av > 0x7F:
+                        return 'a non-ASCII character in a character class'
+                    if multi_byte and in_op == sre_parse.RANGE and in_av[1] > 0x7F:
+                        return 'a non-ASCII range in a character class'
+                subs = []
+            elif op == sre_parse.AT:
+                if av in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY) and not ascii_only:
+                    return r'\b'
+                subs = []
+            elif op == sre_parse.SUBPATTERN:
+                # (?i:...)
+                if av[1] & re.IGNORECASE and not ascii_only:
+                    return 'IGNORECASE'
+                subs = [av[-1]]
+            elif op in Prefilter._repeats():
+                # UTF-8の非ASCII文字に直接量指定子が付くと、最後の1バイトだけの繰り返しになる。
+                sub = av[2]
+                if multi_byte and len(sub) == 1 and sub[0][0] == sre_parse.LITERAL and sub[0][1] > 0x7F:
+                    return 'a repeated non-ASCII character'
+                subs = [sub]
+            elif op == sre_parse.BRANCH:
+                subs = av[1]
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                subs = [av[1]]
+            elif op == sre_parse.GROUPREF_EXISTS:
+                subs = [p for p in av[1:] if p is not None]
+            elif hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+                subs = [av]
+            else:
+                subs = []
+            for p in subs:
+                reason = Grep._bytes_unsafe(p, multi_byte, ascii_only)
+                if reason is not None:
+                    return reason
+        return None
+
+    @staticmethod
+    def crlf_unsafe(bptn):
+        """
+        Check if a bytes pattern may return different matches when '\\r\\n' or '\\r' is not converted to '\\n'
+        :param bptn: compiled bytes regular expression
+        :return: True if the pattern can match '\\r' or '\\n', or uses line anchors ('^', '$')
+        """
+        return Grep._crlf_unsafe(sre_parse.parse(bptn.pattern, bptn.flags))
+
+    @staticmethod
+    def _crlf_unsafe(parsed):
+        # 構文木を辿って、改行文字にマッチし得る部分や、行の境界を見る部分を探す。
+        for op, av in parsed:
+            if op in (sre_parse.ANY, sre_parse.NOT_LITERAL):
+                return True
+            elif op == sre_parse.LITERAL:
+                if av in (0x0A, 0x0D):
+                    return True
+                subs = []
+            elif op == sre_parse.IN:
+                class_chars = Grep._class_chars(av)
+                if class_chars is None:
+                    return True
+                chars, categories = class_chars
+                if chars & {0x0A, 0x0D}:
+                    return True
+                if any(re.fullmatch(Grep.CATEGORIES[c], ch) for c in categories for ch in '\r\n'):
+                    return True
+                subs = []
+            elif op == sre_parse.AT:
+                # \A \Z \b \Bは改行コードの違いで結果が変わらない。
+                if av not in (sre_parse.AT_BEGINNING_STRING, sre_parse.AT_END_STRING,
+                              sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                    return True
+                subs = []
+            else:
+                subs = Grep._subs(op, av)
+                if subs is None:
+                    return True
+            if any(Grep._crlf_unsafe(p) for p in subs):
+                return True
+        return False
+
+    @staticmethod
+    def iter_mmap_matches(fp, bptn, encoding, prefilter=None, crlf_fallback=None):
+        """
+        Search a memory mapped file with a bytes pattern without decoding the whole file
+        :param fp: file path
+        :param bptn: compiled bytes regular expression (see to_bytes_pattern())
+        :param encoding: used to decode only the matched text
+        :param prefilter: Prefilter made from bptn
+        :param crlf_fallback: function(file path) used instead for files with '\\r'
+            テキストモードは改行コード'\\r\\n', '\\r'を'\\n'に変換するが、mmapでは変換しない。
+            改行文字や行末にマッチし得るパターン(crlf_unsafe())の場合に渡す。
+        :return: yield the same value as findall() in text mode
+        """
+        groups = bptn.groups
+        with open(fp, 'rb') as f:
+            # 空のファイルはmmapできない。
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if crlf_fallback is not None and mm.find(b'\r') != -1:
+                    yield from crlf_fallback(fp)
+                    return
+                matches = bptn.finditer(mm) if prefilter is None else prefilter.finditer(bptn, mm)
+                for m in matches:
+                    if groups == 0:
+                        yield m.group().decode(encoding, errors='ignore')
+                    elif groups == 1:
+                        yield (m.group(1) or b'').decode(encoding, errors='ignore')
+                    else:
+                        yield tuple(g.decode(encoding, errors='ignore') for g in m.groups(b''))
+
+    @staticmethod
+    def findall_file(fp, ptn, encoding, prefilter=None):
+        # ファイル全体を読み込んでfindall()する。(従来の方法)
+        with open(fp, 'r', encoding=encoding, errors='ignore') as f:
+            data = f.read()
+        if prefilter is None or prefilter.literal is None:
+            return ptn.findall(data)
+        # リテラルの候補の周辺だけ正規表現を実行する。
+        groups = ptn.groups
+        return [Grep.match_value(m, groups) for m in prefilter.finditer(ptn, data)]
+
+    @staticmethod
+    def searcher(ptn, encoding, stream=False, use_mmap=False, prefilter=True):
+        """
+        Choose how to search a file
+        :param prefilter: True | False
+            True の場合、正規表現に必須のリテラル文字列があれば、それを含まないファイルや行を飛ばす。
+        :return: function(file path) -> iterable of the same value as findall()
+        """
+        pre = Prefilter(ptn) if prefilter else None
+        if stream:
+            text_search = partial(Grep.iter_file_matches, ptn=ptn, encoding=encoding, prefilter=pre)
+        else:
+            text_search = partial(Grep.findall_file, ptn=ptn, encoding=encoding, prefilter=pre)
+        if use_mmap:
+            bptn = Grep.to_bytes_pattern(ptn, encoding)
+            if bptn is not None:
+                bpre = Prefilter(bptn) if prefilter else None
+                # 改行コードで結果が変わるパターンは、'\\r'を含むファイルだけテキストモードで探す。
+                crlf_fallback = text_search if Grep.crlf_unsafe(bptn) else None
+                return partial(Grep.iter_mmap_matches, bptn=bptn, encoding=encoding, prefilter=bpre,
+                               crlf_fallback=crlf_fallback)
+            print('INFO: Falling back to text mode.')
+        return text_search
+
+    @staticmethod
+    def _search_batch(search, fp_lst):
+        # 子プロセスで実行する。ジェネレータはpickleできないのでリストにして返す。
+        return [list(search(fp)) for fp in fp_lst]
+
+    @staticmethod
+    def iter_results(fp_gen, search, workers=1, batch_size=16):
+        """
+        Search files and yield the results in input order
+        :param fp_gen: generator of file paths
+        :param search: function made by searcher()
+        :param workers: process count (1 = search in this process)
+        :param batch_size: files sent to a worker at once
+        :return: yield (file path, iterable of values)
+        """
+        if workers <= 1:
+            for fp in fp_gen:
+                yield fp, search(fp)
+            return
+
+        # 子プロセスに渡したバッチは、渡した順に結果を取り出す。
+        # 先行して渡すバッチ数を制限して、結果がメモリに溜まり過ぎないようにする。
+        executor = ProcessPoolExecutor(max_workers=workers)
+        it = iter(fp_gen)
+        pending = deque()
+
+        def submit_next():
+            batch = list(islice(it, batch_size))
+            if batch:
+                pending.append((batch, executor.submit(Grep._search_batch, search, batch)))
+
+        try:
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                batch, future = pending.popleft()
+                results = future.result()
+                submit_next()
+                yield from zip(batch, results)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def get_dtypes(columns):
+        # Parquet/Featherの列の型をユーザーに設定してもらう。空の場合は推定する。
+        print(f'Column types: {" | ".join(GrepTableWriter.TYPES)} (hit enter to infer from the data)')
+        while True:
+            dtypes = Prompt(f'Types of {columns} split by space: ').get_list()
+            if not dtypes:
+                return None
+            elif len(dtypes) != len(columns):
+                print('Input Error: The type count does not agree the column count!')
+            elif not set(dtypes).issubset(GrepTableWriter.TYPES):
+                print(f'Input Error: Type must be one of {GrepTableWriter.TYPES}!')
+            else:
+                return dtypes
+
+    @staticmethod
+    def grep(path_in, dir_out, stream=False, use_mmap=False, workers=1, out_format='csv'):
+        """
+        Grep files and write the result to dir_out
+        :param path_in: file or folder
+        :param dir_out: output folder
+        :param stream: True | False
+            True の場合、ファイルをチャンク単位で読み、見つけた結果をすぐに書き出す。
+            ファイルサイズや結果の件数に関わらずメモリ使用量が一定になる。
+        :param use_mmap: True | False
+            True の場合、ファイルをmmapしてbytesの正規表現で検索し、マッチした部分だけをデコードする。
+            ASCII互換のエンコーディング(BYTES_ENCODINGS)のみ。
+            ASCII以外で結果が変わるパターン(\\w \\d \\s \\b, '.', [^x], IGNORECASE等)はテキストモードで検索する。
+            改行文字や行末にマッチし得るパターン('.', [^x], \\s, '$'等)は、'\\r'を含むファイルだけテキストモードで検索する。
+        :param workers: process count
+            2以上の場合、ファイルを子プロセスに振り分けて検索する。結果はファイルの順番(並べ替えた場合はその順番)で書き出す。
+        :param out_format: 'csv' | 'parquet' | 'feather'
+            'parquet', 'feather' の場合は列の型を付けて書き出す。(pyarrowが必要。結果は常に逐次書き出す)
+        """
+        if out_format != 'csv' and pa is None:
+            print('ERROR: pyarrow is not installed. Writing csv instead.')
+            out_format = 'csv'
+
         # ファイルを読み込み時のエンコーディングを設定する。
         encoding = input('encoding: ')
 
         # テキスト抽出用の正規表現を設定する。
         ptn = Grep.get_regex()
+        search = Grep.searcher(ptn, encoding, stream=stream, use_mmap=use_mmap)
+
+        if stream or out_format != 'csv':
+            Grep._grep_stream(path_in, dir_out, ptn, search, workers, out_format)
+            return
 
         # ループ
         data = []
-        for fp in Grep.fp_generator(path_in):
+        for fp, values in Grep.iter_results(Grep.fp_generator(path_in), search, workers=workers):
             print(f'\r{fp}', end='')
-            with open(fp, 'r', encoding=encoding, errors='ignore') as f:
-                data.extend(ptn.findall(f.read()))
+            data.extend(values)
         print('\n')
 
         # グループ設定による分岐
@@ -820,6 +3755,303 @@ Typical Group Expressions
             df.to_csv(fp_out)
             print(f'Created {fp_out}')
 
+    @staticmethod
+    def _has_backref(parsed):
+        # 後方参照(\1など)を含むか？ 一つにまとめるとグループ番号がずれるので、まとめられない。
+        for op, av in parsed:
+            if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+                return True
+            if op == sre_parse.SUBPATTERN:
+                subs = [av[-1]]
+            elif op in Prefilter._repeats():
+                subs = [av[2]]
+            elif op == sre_parse.BRANCH:
+                subs = av[1]
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                subs = [av[1]]
+            elif hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+                subs = [av]
+            else:
+                subs = []
+            if any(Grep._has_backref(p) for p in subs):
+                return True
+        return False
+
+    @staticmethod
+    def _has_scoped_ignorecase(parsed):
+        # (?i:...)を含むか？ 大文字・小文字を区別しない部分は、先頭の文字や文字の集合から漏れるので、まとめられない。
+        for op, av in parsed:
+            if op == sre_parse.SUBPATTERN:
+                if av[1] & re.IGNORECASE:
+                    return True
+                subs = [av[-1]]
+            elif op in Prefilter._repeats():
+                subs = [av[2]]
+            elif op == sre_parse.BRANCH:
+                subs = av[1]
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                subs = [av[1]]
+            elif op == sre_parse.GROUPREF_EXISTS:
+                subs = [p for p in av[1:] if p is not None]
+            elif hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+                subs = [av]
+            else:
+                subs = []
+            if any(Grep._has_scoped_ignorecase(p) for p in subs):
+                return True
+        return False
+
+    @staticmethod
+    def combine_patterns(patterns):
+        """
+        Combine patterns into one alternation so that a file is scanned once
+        :param patterns: dict of name -> compiled str regular expression
+        :return: (combined pattern, {group name in combined pattern: (pattern name, group count)})
+            None if the patterns cannot be combined
+            (different flags, IGNORECASE including (?i:...), back references, named groups, inline global flags,
+            or matches of one pattern may overlap those of another)
+        """
+        ptn_lst = list(patterns.values())
+        flags = {p.flags for p in ptn_lst}
+        if len(flags) != 1 or ptn_lst[0].flags & re.IGNORECASE:
+            return None
+        firsts = []
+        alphabets = []
+        for p in ptn_lst:
+            parsed = sre_parse.parse(p.pattern, p.flags)
+            if p.groupindex or Grep._has_backref(parsed) or Grep._has_scoped_ignorecase(parsed) or parsed.getwidth()[0] == 0:
+                return None
+            first, _ = Grep._first_chars(parsed)
+            alphabet = Grep._chars(parsed)
+            if first is None or alphabet is None:
+                return None
+            firsts.append(first)
+            alphabets.append(alphabet)
+        # 選択(|)は同じ位置で最初にマッチした正規表現だけを返し、そのマッチの範囲は他の正規表現で探さない。
+        # どの正規表現の先頭の文字も、他の正規表現のマッチに現れる文字に含まれなければ、
+        # あるマッチの中から別の正規表現のマッチが始まることはないので、別々に走査した結果と同じになる。
+        for i, first in enumerate(firsts):
+            for j, (chars, categories) in enumerate(alphabets):
+                if i == j:
+                    continue
+                if first & chars:
+                    return None
+                # \d などのカテゴリは、先頭の文字がマッチするかで調べる。(フラグはまとめた後と同じ)
+                cat_ptn = [re.compile(Grep.CATEGORIES[c], ptn_lst[0].flags) for c in categories]
+                if any(p.fullmatch(chr(c)) for c in first for p in cat_ptn):
+                    return None
+
+        # 各正規表現を名前付きグループで包む。マッチした正規表現はm.lastgroupで分かる。
+        lookup = {}
+        parts = []
+        for i, (name, p) in enumerate(patterns.items()):
+            lookup[f'_{i}'] = (name, p.groups)
+            parts.append(f'(?P<_{i}>{p.pattern})')
+        try:
+            combined = re.compile('|'.join(parts), flags.pop())
+        # 「(?i)」などのグローバルフラグが先頭以外に来るとエラーになる。
+        except re.error:
+            return None
+        return combined, lookup
+
+    # 文字クラスの範囲を文字の集合に展開する上限。超える場合は、任意の文字とみなす。
+    MAX_CLASS_CHARS = 4096
+
+    CATEGORIES = {sre_parse.CATEGORY_DIGIT: r'\d', sre_parse.CATEGORY_NOT_DIGIT: r'\D',
+                  sre_parse.CATEGORY_SPACE: r'\s', sre_parse.CATEGORY_NOT_SPACE: r'\S',
+                  sre_parse.CATEGORY_WORD: r'\w', sre_parse.CATEGORY_NOT_WORD: r'\W'}
+
+    @staticmethod
+    def _class_chars(items):
+        # 文字クラス([...])の(文字の集合, カテゴリの集合)。否定や大きな範囲はNone(任意の文字)
+        chars = set()
+        categories = set()
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                chars.add(av)
+            elif op == sre_parse.RANGE and av[1] - av[0] < Grep.MAX_CLASS_CHARS:
+                chars.update(range(av[0], av[1] + 1))
+            elif op == sre_parse.CATEGORY and av in Grep.CATEGORIES:
+                categories.add(av)
+            else:
+                return None
+        return chars, categories
+
+    @staticmethod
+    def _subs(op, av):
+        # 文字を消費する子の構文木。先読み・後読みは消費しないので含めない。
+        if op == sre_parse.SUBPATTERN:
+            return [av[-1]]
+        if op in Prefilter._repeats():
+            return [av[2]]
+        if op == sre_parse.BRANCH:
+            return av[1]
+        if hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP:
+            return [av]
+        return None
+
+    @staticmethod
+    def _chars(parsed):
+        # マッチに現れ得る(文字の集合, カテゴリの集合)。None = 任意の文字
+        chars = set()
+        categories = set()
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                chars.add(av)
+                continue
+            if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                continue
+            if op == sre_parse.IN:
+                subs = [Grep._class_chars(av)]
+            else:
+                subs = Grep._subs(op, av)
+                if subs is None:
+                    return None
+                subs = [Grep._chars(p) for p in subs]
+            for sub in subs:
+                if sub is None:
+                    return None
+                chars |= sub[0]
+                categories |= sub[1]
+        return chars, categories
+
+    @staticmethod
+    def _first_chars(parsed):
+        # (マッチの先頭になり得る文字の集合, 空にマッチし得るか) 集合がNone = 任意の文字
+        first = set()
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                return first | {av}, False
+            if op == sre_parse.IN:
+                # 先頭がカテゴリ(\d など)の場合は、文字の集合にできないのでNone
+                sub = Grep._class_chars(av)
+                return (None if sub is None or sub[1] else first | sub[0]), False
+            if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                continue
+            if op == sre_parse.SUBPATTERN or (hasattr(sre_parse, 'ATOMIC_GROUP') and op == sre_parse.ATOMIC_GROUP):
+                sub, nullable = Grep._first_chars(Grep._subs(op, av)[0])
+            elif op in Prefilter._repeats():
+                sub, nullable = Grep._first_chars(av[2])
+                nullable = nullable or av[0] == 0
+            elif op == sre_parse.BRANCH:
+                sub = set()
+                nullable = False
+                for p in av[1]:
+                    alt, alt_nullable = Grep._first_chars(p)
+                    if alt is None:
+                        return None, False
+                    sub |= alt
+                    nullable = nullable or alt_nullable
+            else:
+                return None, False
+            if sub is None:
+                return None, False
+            first |= sub
+            if not nullable:
+                return first, False
+        return first, True
+
+    @staticmethod
+    def findall_file_multi(fp, patterns, encoding, combined=None):
+        """
+        Read a file once and search it with multiple patterns
+        :param patterns: dict of name -> compiled str regular expression
+        :param combined: return value of combine_patterns() (None = scan once per pattern)
+        :return: list of (name, list of the same value as findall())
+        """
+        with open(fp, 'r', encoding=encoding, errors='ignore') as f:
+            data = f.read()
+        if combined is None:
+            return [(name, p.findall(data)) for name, p in patterns.items()]
+
+        ptn, lookup = combined
+        result = {name: [] for name in patterns}
+        for m in ptn.finditer(data):
+            name, groups = lookup[m.lastgroup]
+            i = m.lastindex
+            if groups == 0:
+                value = m.group(i)
+            elif groups == 1:
+                value = m.group(i + 1) or ''
+            else:
+                value = tuple(m.group(k) or '' for k in range(i + 1, i + 1 + groups))
+            result[name].append(value)
+        # iter_results()はリストに変換するので、dictではなく(名前, 結果)のリストで返す。
+        return list(result.items())
+
+    @staticmethod
+    def get_patterns():
+        # 名前付きで複数の正規表現を設定してもらう。名前は出力ファイル名(grep_<名前>)に使う。
+        patterns = {}
+        while True:
+            name = input('Pattern name (hit enter to finish): ')
+            if not name:
+                return patterns
+            elif name in patterns:
+                print(f'ERROR: {name} is already used!')
+            else:
+                patterns[name] = Grep.get_regex()
+
+    @staticmethod
+    def grep_multi(path_in, dir_out, patterns=None, combine=False, workers=1):
+        """
+        Grep files with multiple named patterns. Each file is read only once.
+        :param path_in: file or folder
+        :param dir_out: output folder. The result of each pattern goes to grep_<name>.txt/csv
+        :param patterns: dict of name -> compiled regular expression (None = ask user)
+        :param combine: True | False
+            True の場合、結果が変わらないことを確認できれば、全ての正規表現を一つの選択(|)にまとめ、
+            ファイルを一回だけ走査する。マッチが重なり得る場合(\\w や '.' を含む等)はまとめない。
+            False の場合も、ファイルの読み込みは一回だけで、正規表現毎に走査する。
+        :param workers: process count
+        """
+        encoding = input('encoding: ')
+        if patterns is None:
+            patterns = Grep.get_patterns()
+        if not patterns:
+            print('ERROR: No pattern is set!')
+            return
+
+        combined = Grep.combine_patterns(patterns) if combine else None
+        if combine and combined is None:
+            print('INFO: The patterns cannot be combined. Each pattern scans the file separately.')
+        search = partial(Grep.findall_file_multi, patterns=patterns, encoding=encoding, combined=combined)
+
+        # 正規表現毎の出力ファイル
+        writers = {}
+        for name, p in patterns.items():
+            print(f'Pattern: {name}')
+            columns = Grep.get_columns(expected_length=p.groups) if p.groups > 0 else None
+            writers[name] = GrepWriter(dir_out, p.groups, columns, name=f'grep_{name}')
+
+        try:
+            for fp, result in Grep.iter_results(Grep.fp_generator(path_in), search, workers=workers):
+                print(f'\r{fp}', end='')
+                for name, values in result:
+                    for value in values:
+                        writers[name].write(value)
+            print('\n')
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    @staticmethod
+    def _grep_stream(path_in, dir_out, ptn, search, workers=1, out_format='csv'):
+        # CSVのヘッダーを先に書くので、列名は検索の前に設定してもらう。
+        columns = Grep.get_columns(expected_length=ptn.groups) if ptn.groups > 0 else None
+        if out_format == 'csv':
+            writer = GrepWriter(dir_out, ptn.groups, columns)
+        else:
+            dtypes = Grep.get_dtypes(columns or ['match'])
+            writer = GrepTableWriter(dir_out, ptn.groups, columns, fmt=out_format, dtypes=dtypes)
+
+        with writer:
+            for fp, values in Grep.iter_results(Grep.fp_generator(path_in), search, workers=workers):
+                print(f'\r{fp}', end='')
+                for value in values:
+                    writer.write(value)
+            print('\n')
+
 
 class Scramble:
     # TODO パスワード等を保存するテキストファイルをエンコード・デコードし、スクロールテキストWidget上で編集保存できるようにする。
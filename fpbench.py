@@ -0,0 +1,560 @@
+from fpath import *
+import time
+import random
+import tempfile
+import json
+import platform
+import argparse
+import contextlib
+import io
+
+
+# 0.0.0 Original (Grepのテキストモードとmmapモードの比較)
+# 0.1.0 BenchSuite (Dummyで作ったフォルダでの列挙・フィルタ・Grep・コピー・削除・集計・XML整形の計測、JSONでベースラインと比較)を追加
+# 0.2.0 Check (計測ではなく、各モードの結果が基準と同じかの確認)を追加
+__version__ = '0.2.0'
+
+
+class Bench:
+    """ Base """
+
+    @staticmethod
+    def time_it(fnc, repeat=3, setup=None, quiet=False):
+        """
+        Best of N
+        :param fnc: function to time
+        :param repeat: best of N
+        :param setup: function called before each run. 計測には含めない。(コピー先の削除等)
+        :param quiet: True = discard what fnc prints
+        :return: (seconds, return value)
+        """
+        # 最速の実行時間(秒)と、その時の戻り値を返す。
+        best = None
+        ret = None
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+                t0 = time.perf_counter()
+                ret = fnc()
+                sec = time.perf_counter() - t0
+            if best is None or sec < best:
+                best = sec
+        return best, ret
+
+
+class BenchGrep(Bench):
+    """ Grep """
+
+    @staticmethod
+    def make_log(dir_out, file_name='bench.log', line_count=500000):
+        # ASCIIのログファイルを作る。乱数の種は固定。
+        rnd = random.Random(0)
+        levels = ['INFO', 'WARN', 'ERROR', 'DEBUG']
+        fp = os.path.join(dir_out, file_name)
+        with open(fp, 'w', encoding='utf-8', newline='\n') as f:
+            for i in range(line_count):
+                f.write(f'2024-01-{rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d} '
+                        f'[{rnd.choice(levels)}] id=({rnd.randint(-9999, 9999)}) '
+                        f'addr=0x{rnd.randint(0, 0xFFFFFF):06x} message {i}\n')
+        return fp
+
+    @staticmethod
+    def mmap_searcher(ptn, encoding='utf-8'):
+        """
+        Grep.searcher(use_mmap=True) that is sure to search with mmap
+        テキストモードに切り替わると、mmapモードの名前でテキストモードを計測してしまうので、エラーにする。
+        :return: function(file path) -> iterable of the same value as findall()
+        """
+        search = Grep.searcher(ptn, encoding, use_mmap=True)
+        if search.func is not Grep.iter_mmap_matches or search.keywords['crlf_fallback'] is not None:
+            raise ValueError(f'ERROR: {ptn.pattern!r} is not searched with mmap for {encoding}. Use an ASCII-only pattern.')
+        return search
+
+    @staticmethod
+    def compare_modes(fp_lst, ptn, encoding='utf-8', repeat=3):
+        """
+        Compare the text mode and the mmap bytes mode of Grep
+        :param fp_lst: list of file paths
+        :param ptn: compiled str regular expression
+        :param encoding: file encoding
+        :param repeat: best of N
+        :return: dict of seconds per mode
+        """
+        total = sum(os.path.getsize(fp) for fp in fp_lst)
+        modes = {'text': Grep.searcher(ptn, encoding),
+                 'mmap': BenchGrep.mmap_searcher(ptn, encoding)}
+
+        result = {}
+        reference = None
+        print(f' Grep {len(fp_lst)} files, {total:,} bytes '.center(60, '='))
+        for name, search in modes.items():
+            sec, data = Bench.time_it(lambda: [v for fp in fp_lst for v in search(fp)], repeat=repeat)
+            result[name] = sec
+            # 結果が同じであることも確認する。
+            if reference is None:
+                reference = data
+                same = ''
+            else:
+                same = 'same result' if data == reference else 'DIFFERENT RESULT!'
+            print(f'{name:<8}: {sec:>8.3f} sec {total / sec / 1024 ** 2:>10.1f} MB/s  {len(data):>10,} hits  {same}')
+        return result
+
+
+class Fixture:
+    """ 再現できる計測用のフォルダ。乱数の種は固定し、Dummyで作る。
+    root/
+        tree/   深いツリー (Dummy.dummy_tree)
+        wide/   浅く広いツリー (Dummy.dummy_tree)
+        log/    大きなログファイル
+        big/    大きなファイル (Dummy.dummy_file_by_size)
+        xml/    XMLファイル群"""
+
+    def __init__(self, root, scale=1):
+        """
+        Constructor
+        :param root: folder to build in
+        :param scale: 1 = a few seconds per case. 大きくするとファイル数とサイズが増える。
+        """
+        self.root = root
+        self.scale = scale
+        self.tree = os.path.join(root, 'tree')
+        self.wide = os.path.join(root, 'wide')
+        self.log = os.path.join(root, 'log')
+        self.big = os.path.join(root, 'big')
+        self.xml = os.path.join(root, 'xml')
+
+    def __repr__(self):
+        return f'Fixture({self.root!r}, scale={self.scale})'
+
+    @staticmethod
+    def make_xml(dir_out, file_count=100, item_count=200):
+        # 要素と属性、テキストを持つ整形されていないXML。乱数の種は固定。
+        rnd = random.Random(0)
+        for i in range(file_count):
+            fp = os.path.join(dir_out, f'doc{i:05d}.xml')
+            with open(fp, 'w', encoding='utf-8') as f:
+                f.write(f'<?xml version="1.0" encoding="UTF-8"?><root id="{i}">')
+                for j in range(item_count):
+                    f.write(f'<item no="{j}" kind="{rnd.choice("abcde")}"><name>name {rnd.randint(0, 99999)}</name>'
+                            f'<value>{rnd.random():.6f}</value><tags><tag>x</tag><tag>y</tag></tags></item>')
+                f.write('</root>')
+
+    def build(self):
+        # 既にある場合は作り直さない。(同じscaleで作ったものを使いまわす)
+        fp_mark = os.path.join(self.root, f'fixture-{self.scale}.done')
+        if os.path.isfile(fp_mark):
+            print(f'INFO: reusing fixture in {self.root}')
+            return self
+        print(f'Building fixture in {self.root}')
+        for dp in [self.tree, self.wide, self.log, self.big, self.xml]:
+            os.makedirs(dp, exist_ok=True)
+        # dummy_treeはノード毎にprintするので捨てる。
+        with contextlib.redirect_stdout(io.StringIO()):
+            Dummy.dummy_tree(dir_out=self.tree, depth=3, count=5 + self.scale)
+            Dummy.dummy_tree(dir_out=self.wide, depth=0, count=2000 * self.scale)
+            Dummy.dummy_file_by_size(dir_out=self.big, file_name='big.dat', file_size=64 * 1024 ** 2 * self.scale)
+        BenchGrep.make_log(self.log, line_count=500000 * self.scale)
+        Fixture.make_xml(self.xml, file_count=100 * self.scale)
+        with open(fp_mark, 'w') as f:
+            f.write(__version__)
+        return self
+
+
+class BenchSuite(Bench):
+    """ fpathの主な処理の計測。結果はJSONに保存し、ベースラインと比べる。"""
+
+    # ベースラインより、この割合以上遅くなったら退行とみなす。
+    THRESHOLD = 0.10
+
+    def __init__(self, fixture, repeat=3, workers=4):
+        self.fixture = fixture
+        self.repeat = repeat
+        self.workers = workers
+        self.dir_work = os.path.join(fixture.root, 'work')
+        # name -> {'seconds': 秒, 'items': 件数}
+        self.results = {}
+
+    def __repr__(self):
+        return f'BenchSuite({self.fixture!r}, repeat={self.repeat}, workers={self.workers})'
+
+    def _work(self, name):
+        # 計測毎の作業フォルダを空にする。
+        dp = os.path.join(self.dir_work, name)
+        if os.path.isdir(dp):
+            shutil.rmtree(dp)
+        os.makedirs(dp)
+        return dp
+
+    def cases(self):
+        # (名前, 計測する関数, 前処理) 関数は処理した件数を返す。
+        fx = self.fixture
+        w = self.workers
+        dst = os.path.join(self.dir_work, 'copy')
+        victim = os.path.join(self.dir_work, 'delete')
+        out_xml = os.path.join(self.dir_work, 'xml')
+        fp_log = os.path.join(fx.log, 'bench.log')
+        # \w \dはUTF-8のmmapモードでは使えない。(テキストモードに切り替わる) ASCIIの範囲で書く。
+        ptn = re.compile(r'\[([A-Z]+)\] id=\((-?[0-9]+)\)')
+        search_mmap = BenchGrep.mmap_searcher(ptn, 'utf-8')
+        xml_lst = sorted(Mapper(fx.xml).path_generator())
+
+        def copy_tree():
+            self._work('delete')
+            shutil.copytree(fx.tree, victim, dirs_exist_ok=True)
+
+        def pretty_all():
+            for fp in xml_lst:
+                Xml.pretty_stream(fp, os.path.join(out_xml, os.path.basename(fp)))
+            return len(xml_lst)
+
+        return [
+            ('walk', lambda: sum(1 for _ in Mapper(fx.tree).path_generator('all')), None),
+            ('walk_parallel', lambda: sum(1 for _ in Mapper(fx.tree, workers=w, ordered=False).path_generator('all')),
+             None),
+            ('walk_wide', lambda: sum(1 for _ in Mapper(fx.wide).path_generator('all')), None),
+            ('filter_regex', lambda: sum(1 for _ in Filter.by_regex(fx.tree, pattern=re.compile(r'.*\.csv$', re.I))),
+             None),
+            ('grep_text', lambda: sum(1 for _ in Grep.searcher(ptn, 'utf-8')(fp_log)), None),
+            ('grep_mmap', lambda: sum(1 for _ in search_mmap(fp_log)), None),
+            ('copy_tree', lambda: CopyEngine(fx.tree, dst, workers=w).run(Mapper(fx.tree).path_generator()).files,
+             lambda: self._work('copy')),
+            ('copy_big', lambda: CopyEngine(fx.big, dst, workers=w).run(Mapper(fx.big).path_generator()).files,
+             lambda: self._work('copy')),
+            ('delete_files', lambda: DeleteEngine(workers=w).collect(
+                victim, lambda e: e.is_file() and e.name.endswith('.txt')).run().deleted, copy_tree),
+            ('delete_tree', lambda: DeleteEngine(workers=w).collect(
+                os.path.dirname(victim), lambda e: e.path == victim).run().deleted, copy_tree),
+            ('count', lambda: DiskUsage(fx.tree).scan(workers=w).file_count, None),
+            ('xml_check', lambda: sum(1 for fp in xml_lst if Xml.check(fp) is None), None),
+            ('xml_prettify', pretty_all, lambda: os.makedirs(out_xml, exist_ok=True)),
+        ]
+
+    def run(self, names=None):
+        """
+        Run the cases
+        :param names: list of case names (None = all)
+        :return: self
+        """
+        print(f' BenchSuite {__version__} '.center(60, '='))
+        for name, fnc, setup in self.cases():
+            if names and name not in names:
+                continue
+            sec, items = Bench.time_it(fnc, repeat=self.repeat, setup=setup, quiet=True)
+            self.results[name] = {'seconds': sec, 'items': items}
+            print(f'{name:<16}: {sec:>8.3f} sec {items or 0:>12,} items')
+        shutil.rmtree(self.dir_work, ignore_errors=True)
+        return self
+
+    def to_dict(self):
+        return {'version': __version__,
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'scale': self.fixture.scale,
+                'repeat': self.repeat,
+                'workers': self.workers,
+                'results': self.results}
+
+    def save(self, fp_out):
+        with open(fp_out, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f'INFO: saved {fp_out}')
+
+    @staticmethod
+    def compare(current, baseline, threshold=None):
+        """
+        Compare with a baseline
+        :param current: dict of to_dict()
+        :param baseline: dict of to_dict()
+        :param threshold: slower than baseline * (1 + threshold) is a regression
+        :return: list of regressed case names
+        """
+        threshold = BenchSuite.THRESHOLD if threshold is None else threshold
+        if current.get('scale') != baseline.get('scale'):
+            print(f'INFO: scale differs (baseline={baseline.get("scale")}, current={current.get("scale")}).')
+        print(f' Compare with baseline {baseline.get("created", "")} '.center(60, '='))
+        regressed = []
+        for name, cur in current['results'].items():
+            base = baseline['results'].get(name)
+            if base is None:
+                print(f'{name:<16}: {cur["seconds"]:>8.3f} sec  (new)')
+                continue
+            ratio = cur['seconds'] / max(base['seconds'], 1e-9)
+            if ratio > 1 + threshold:
+                mark = 'REGRESSION'
+                regressed.append(name)
+            elif ratio < 1 - threshold:
+                mark = 'faster'
+            else:
+                mark = ''
+            if cur.get('items') != base.get('items'):
+                mark += ' (item count differs)'
+            print(f'{name:<16}: {base["seconds"]:>8.3f} -> {cur["seconds"]:>8.3f} sec {ratio:>6.2f}x  {mark}')
+        return regressed
+
+
+class Check:
+    """ 速いモードが基準(re.findall等)と同じ結果を返すかの確認。失敗した件数を返す。"""
+
+    @staticmethod
+    def report(name, ref, data, detail=''):
+        # 違う場合だけ詳細を表示する。
+        if data == ref:
+            return 0
+        print(f'DIFFERENT RESULT! {name} {detail}')
+        print(f'  expected: {ref!r:.200}')
+        print(f'  actual  : {data!r:.200}')
+        return 1
+
+    @staticmethod
+    def stream_boundaries(dir_tmp, rounds=300, seed=0):
+        # 小さなチャンクで、チャンクの境界をまたぐマッチを作り、ファイル全体へのre.findall()と比べる。
+        # '^'や後読みは持ち越した位置を先頭とみなす仕様なので、対象外。
+        rnd = random.Random(seed)
+        patterns = [re.compile(r'a\d*x|\d'),
+                    re.compile(r'id=\((-?\d+)\)|(\d{4})'),
+                    re.compile(r'\[(\w+)\] id=\((-?\d+)\)'),
+                    re.compile(r'ERROR'),
+                    re.compile(r'(\d+)-(\d*)x?')]
+        pieces = ['a', 'x', '1', '23', '456', '-', 'id=(', ')', '[ERROR] ', '[INFO] ', 'ERR', 'OR', '\n', ' ']
+        fp = os.path.join(dir_tmp, 'stream.txt')
+        failed = 0
+        for i in range(rounds):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 200)))
+            with open(fp, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            # マッチの長さはoverlap以下になるようにしておく。
+            chunk_size = rnd.randint(1, 40)
+            overlap = 32
+            for ptn in patterns:
+                data = list(Grep.iter_file_matches(fp, ptn, 'utf-8', chunk_size=chunk_size, overlap=overlap))
+                failed += Check.report('stream', ptn.findall(text), data,
+                                       f'{ptn.pattern!r} chunk={chunk_size} text={text!r:.80}')
+        print(f'stream boundaries: {rounds * len(patterns):,} cases, {failed} failed')
+        return failed
+
+    @staticmethod
+    def mmap_modes(dir_tmp, rounds=100, seed=0):
+        # 非ASCIIを含むUTF-8のファイルで、mmapモードとテキストモードの結果を比べる。
+        # bytesで意味の変わるパターンは、テキストモードに切り替わるはず。
+        # 改行コードが'\r\n', '\r'のファイルでも比べる。
+        rnd = random.Random(seed)
+        patterns = [re.compile(e) for e in [r'user=(\w+)', r'user=(.{4}) ', r'user=([^ ]+)', r'(?i)USER=(\S+)',
+                                              r'user=(caf[é])', r'é+', r'(é)+', r'\bid=(\d+)', r'(?a)user=(\w+)',
+                                              r'user=(caf)é', r'id=(\d+)|東京']]
+        pieces = ['user=', 'café', 'cafe', '東京', 'é', 'ée', 'id=', '12', '٣', ' ', '\n', 'x', 'USER=']
+        fp = os.path.join(dir_tmp, 'mmap.txt')
+        failed = 0
+        for i in range(rounds):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 100)))
+            with open(fp, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            for ptn in patterns:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ref = list(Grep.searcher(ptn, 'utf-8')(fp))
+                    data = list(Grep.searcher(ptn, 'utf-8', use_mmap=True)(fp))
+                failed += Check.report('mmap', ref, data, f'{ptn.pattern!r} text={text!r:.80}')
+        cases = rounds * len(patterns)
+
+        # 改行コードが'\r\n', '\r'のファイル。テキストモードは'\n'に変換して読む。
+        patterns = [re.compile(e) for e in [r'ERROR\] (.*)', r'(?m)^ERROR\] (\w+)$', r'ERROR\] ([a-z ]+)$',
+                                              r'(?a)full\s+(\w+)', r'ERROR\] ([^\]]+)', r'ERROR\] ([a-z]+)',
+                                              r'full\n', r'(?s)full(.)']]
+        pieces = ['ERROR] ', 'disk', ' ', 'full', 'x', '\r\n', '\r', '\n', ']']
+        for i in range(rounds):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 60)))
+            with open(fp, 'w', encoding='ascii', newline='') as f:
+                f.write(text)
+            for encoding in ['ascii', 'cp1252']:
+                for ptn in patterns:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        ref = list(Grep.searcher(ptn, encoding)(fp))
+                        data = list(Grep.searcher(ptn, encoding, use_mmap=True)(fp))
+                    failed += Check.report('mmap crlf', ref, data, f'{encoding} {ptn.pattern!r} text={text!r:.80}')
+        cases += rounds * 2 * len(patterns)
+        print(f'mmap modes: {cases:,} cases, {failed} failed')
+        return failed
+
+    @staticmethod
+    def multi_patterns(dir_tmp, rounds=300, seed=0):
+        # 複数の正規表現をまとめた走査(combine)と、正規表現毎の走査の結果を比べる。
+        rnd = random.Random(seed)
+        pool = [r'(\w+)=\((-?\d+)\)', r'err', r'ERROR', r'WARN', r'ROR', r'id=\((-?\d+)\)', r'\[(\w+)\]',
+                r'addr=(0x[0-9a-f]+)', r'x+', r'(?:a|b)c', r'ab\d+', r'b\d', r'(?<=z)q+', r'\d{2}']
+        pieces = ['ERROR', 'WARN', 'err', 'id=(', '-', '12', '3', ')', '[', ']', 'addr=0x', 'ff', 'ab', 'bc', 'ac',
+                  'x', 'zq', 'q', ' ', '\n']
+        fp = os.path.join(dir_tmp, 'multi.txt')
+        failed = 0
+        combined_count = 0
+        for i in range(rounds):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 200)))
+            with open(fp, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            patterns = {f'p{k}': re.compile(e) for k, e in enumerate(rnd.sample(pool, rnd.randint(2, 4)))}
+            combined = Grep.combine_patterns(patterns)
+            if combined is None:
+                continue
+            combined_count += 1
+            ref = Grep.findall_file_multi(fp, patterns, 'utf-8')
+            data = Grep.findall_file_multi(fp, patterns, 'utf-8', combined=combined)
+            failed += Check.report('multi', ref, data, f'{[p.pattern for p in patterns.values()]} text={text!r:.80}')
+        # (?i:...)の部分は大文字・小文字の両方が先頭になり得る。
+        fixed = [({'a': re.compile(r'(?i:err)\d'), 'b': re.compile(r'E[R-Z]')}, 'ERR5 and Ex')]
+        for patterns, text in fixed:
+            with open(fp, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            combined = Grep.combine_patterns(patterns)
+            ref = Grep.findall_file_multi(fp, patterns, 'utf-8')
+            data = Grep.findall_file_multi(fp, patterns, 'utf-8', combined=combined)
+            failed += Check.report('multi', ref, data, f'{[p.pattern for p in patterns.values()]} text={text!r:.80}')
+        rounds += len(fixed)
+        print(f'multi patterns: {rounds:,} cases, {combined_count:,} combined, {failed} failed')
+        return failed
+
+    @staticmethod
+    def xml_check(dir_tmp):
+        # Xml.check()の判定とエラーの位置が、ツリーを作るXml(fp).errと同じか？
+        cases = [b'<root><a>t</a><b/></root>', b'<root><x:a/></root>', b'<root>\n  <x:a>t</x:a>\n<y:b/></root>',
+                 b'<r xmlns:x="u"><x:a/></r>', b'<root><a></root>', b'<r>&foo;</r>', b'<r a="1" a="2"/>',
+                 b'<r><x:a/><b></r>', b'<r>' + b'<a>t</a>' * 10000 + b'<a></r>', b'', b'<r/><r/>']
+        fp = os.path.join(dir_tmp, 'check.xml')
+        failed = 0
+        for data in cases:
+            with open(fp, 'wb') as f:
+                f.write(data)
+            with contextlib.redirect_stdout(io.StringIO()):
+                ref = Xml(fp).err
+            err = Xml.check(fp)
+            ref = None if ref is None else (ref.msg, ref.position)
+            err = None if err is None else (err.msg, err.position)
+            failed += Check.report('xml check', ref, err, f'{data!r:.80}')
+        print(f'xml check: {len(cases):,} cases, {failed} failed')
+        return failed
+
+    @staticmethod
+    def delete_partial(dir_tmp):
+        # 一部が削除できない場合も、解放したバイト数が実際に消えた分と一致するか？
+        # 書き込み権限の無いフォルダで失敗させるので、rootでは(権限を無視して消せるので)確認できない。
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            print('delete partial: skipped (running as root)')
+            return 0
+        failed = 0
+        for use_fd in sorted({False, DeleteEngine.USE_FD}):
+            # 削除の方法毎に作り直す。
+            root = os.path.join(dir_tmp, f'delete{int(use_fd)}')
+            target = os.path.join(root, 'target')
+            locked = os.path.join(target, 'a', 'locked')
+            for dp in [os.path.join(target, 'a', 'b'), locked]:
+                os.makedirs(dp)
+            for i, dp in enumerate([target, os.path.join(target, 'a'), os.path.join(target, 'a', 'b'), locked]):
+                with open(os.path.join(dp, f'f{i}.dat'), 'wb') as f:
+                    f.write(b'x' * 1000 * (i + 1))
+            before = DeleteEngine.tree_size(target)
+            os.chmod(locked, 0o500)
+            engine = DeleteEngine(workers=1)
+            saved = DeleteEngine.USE_FD
+            DeleteEngine.USE_FD = use_fd
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    engine.collect(root, lambda e: e.path == target).run()
+            finally:
+                DeleteEngine.USE_FD = saved
+                os.chmod(locked, 0o700)
+            expected = before - DeleteEngine.tree_size(target)
+            failed += Check.report('delete partial', expected, engine.bytes, f'use_fd={use_fd}')
+            failed += Check.report('delete partial errors', True, bool(engine.errors), f'use_fd={use_fd}')
+        print(f'delete partial: {failed} failed')
+        return failed
+
+    @staticmethod
+    def delete_symlink(dir_tmp):
+        # 名前が一致したフォルダへのシンボリックリンクは、リンク先ではなくリンク自体を削除するか？
+        # dry runの見積もりと実際に解放したバイト数も一致するはず。
+        if not hasattr(os, 'symlink'):
+            print('delete symlink: skipped (no symlink)')
+            return 0
+        root = os.path.join(dir_tmp, 'symlink')
+        keep = os.path.join(root, 'keep')
+        os.makedirs(keep)
+        with open(os.path.join(keep, 'big.dat'), 'wb') as f:
+            f.write(b'x' * 100000)
+        link = os.path.join(root, 'src', '__pycache__')
+        os.makedirs(os.path.dirname(link))
+        os.symlink(keep, link)
+        match = lambda e: e.is_dir() and e.name == '__pycache__'
+        with contextlib.redirect_stdout(io.StringIO()):
+            plan = DeleteEngine(dry_run=True).collect(os.path.dirname(link), match).run()
+            engine = DeleteEngine().collect(os.path.dirname(link), match).run()
+        failed = Check.report('delete symlink bytes', plan.bytes, engine.bytes)
+        failed += Check.report('delete symlink', (False, ['big.dat'], 0),
+                               (os.path.lexists(link), os.listdir(keep), len(engine.errors)))
+        print(f'delete symlink: {failed} failed')
+        return failed
+
+    @staticmethod
+    def run_all():
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            return (Check.stream_boundaries(dir_tmp) + Check.mmap_modes(dir_tmp) +
+                    Check.multi_patterns(dir_tmp) + Check.xml_check(dir_tmp) + Check.delete_partial(dir_tmp) +
+                    Check.delete_symlink(dir_tmp))
+
+
+def entry_suite(args):
+    parser = argparse.ArgumentParser(prog='fpbench.py suite', description='Benchmark fpath hot paths')
+    parser.add_argument('--root', help='fixture folder (default: a temporary folder)')
+    parser.add_argument('--scale', type=int, default=1, help='fixture size multiplier')
+    parser.add_argument('--repeat', type=int, default=3, help='best of N')
+    parser.add_argument('--workers', type=int, default=4, help='thread count')
+    parser.add_argument('--only', nargs='*', help='case names to run')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with this JSON file')
+    parser.add_argument('--threshold', type=float, default=BenchSuite.THRESHOLD,
+                        help='slower than baseline by this ratio is a regression')
+    opts = parser.parse_args(args)
+
+    # --rootが無い場合は一時フォルダに作り、終わったら消す。
+    with contextlib.ExitStack() as stack:
+        root = opts.root or stack.enter_context(tempfile.TemporaryDirectory())
+        fixture = Fixture(root, scale=opts.scale).build()
+        suite = BenchSuite(fixture, repeat=opts.repeat, workers=opts.workers).run(opts.only)
+    if opts.save:
+        suite.save(opts.save)
+    if opts.baseline:
+        with open(opts.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressed = BenchSuite.compare(suite.to_dict(), baseline, opts.threshold)
+        if regressed:
+            print(f'ERROR: {len(regressed)} regression(s): {", ".join(regressed)}')
+            # CIで検知できるように終了コードで知らせる。
+            sys.exit(1)
+
+
+def entry():
+    # python fpbench.py suite ... は全体の計測
+    if len(sys.argv) >= 2 and sys.argv[1] == 'suite':
+        entry_suite(sys.argv[2:])
+        return
+    # python fpbench.py check は結果の確認
+    if len(sys.argv) >= 2 and sys.argv[1] == 'check':
+        if Check.run_all():
+            sys.exit(1)
+        return
+
+    # 入力ファイルが無い場合は、一時フォルダにログファイルを作り、終わったら消す。
+    with contextlib.ExitStack() as stack:
+        if len(sys.argv) == 2 and os.path.exists(sys.argv[1]):
+            fp_lst = list(Mapper(sys.argv[1]).path_generator())
+        else:
+            dir_tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            print(f'Creating sample log in {dir_tmp}')
+            fp_lst = [BenchGrep.make_log(dir_tmp)]
+
+        # 件数の少ない検索と多い検索。mmapモードはマッチ毎にデコードするので、件数が少ないほど有利。
+        for expr in [r'id=\(-9999\)', r'ERROR', r'\[([A-Z]+)\] id=\((-?[0-9]+)\)', r'addr=(0x[0-9a-fA-F]+)']:
+            BenchGrep.compare_modes(fp_lst, re.compile(expr))
+
+
+if __name__ == '__main__':
+    entry()
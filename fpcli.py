@@ -8,7 +8,26 @@ from functools import partial
 # 0.0.0 Original
 # 0.0.1 Fixed bug on grep
 # 0.1.0 CliGrep.create_rgx() を追加
-__version__ = '0.1.0'
+# 0.2.0 CliTop.index() を追加
+# 0.3.0 CliGrep.grep_files_stream() を追加
+# 0.4.0 CliGrep.grep_files_mmap() を追加
+# 0.5.0 CliGrep.grep_files_parallel() を追加
+# 0.6.0 CliGrep.grep_files_table() を追加
+# 0.7.0 CliGrep.grep_files_multi() を追加
+# 0.8.0 CliXml.set_threads() を追加 (XMLの検証・整形をスレッドで並列化)
+# 0.9.0 CliXml.count_element_names() をiterparseでの集計にし、フォルダ全体の合計もできるようにした。
+# 0.10.0 CliXml.prettify_utf8() をXml.pretty_stream()での書き出しにした。
+# 0.11.0 CliXml.check_file_corruption() をツリーを作らない整形式チェックにした。
+# 0.12.0 CliXml.set_incremental() を追加 (前回から変化の無いファイルを飛ばす)
+# 0.13.0 CliCopy.set_threads() を追加 (コピーのスレッド数)
+# 0.14.0 CliCopy.set_sync() を追加 (出力先が最新のファイルはコピーしない、dry run)
+# 0.15.0 CliXml.prettify_utf8() でmkdirの集計(DirMaker)を表示するようにした。
+# 0.16.0 CliDelete.set_dry_run() を追加
+# 0.17.0 CliMisc.disk_usage() を追加
+# 0.18.0 CliMisc.find_duplicates() を追加
+# 0.19.0 CliDummy.generate_tree() を追加
+# 0.20.0 CliXml.prettify_utf8() のmkdirの記録と集計を実行毎のDirMakerにした。
+__version__ = '0.20.0'
 
 
 class Cli:
@@ -118,13 +137,65 @@ Create a dummy file by the specified byte size."""
         file_name = input('File name: ')
         Dummy.dummy_file_by_size(dir_out=self.dir_out, file_name=file_name, file_size=file_size)
 
+    def generate_tree(self):
+        """Generate
+Generate a large tree of log/XML/binary files in parallel with a fixed seed."""
+        fan_out = Prompt('Sub folders per folder: ').get_int()
+        depth = Prompt('How deep?').get_int()
+        files_per_dir = Prompt('Files per folder: ').get_int()
+        size_max = Prompt('Max file size (bytes): ').get_int()
+        corrupt_ratio = Prompt('Ratio of broken XML files (0.0 - 1.0): ').get_float()
+        seed = Prompt('Random seed: ').get_int()
+        workers = Prompt(f'Thread count (CPU count={os.cpu_count()}): ').get_int()
+        DummyGenerator(self.dir_out, fan_out=fan_out, depth=depth, files_per_dir=files_per_dir,
+                       size_min=min(1024, size_max), size_max=size_max, corrupt_ratio=corrupt_ratio,
+                       seed=seed, workers=workers).run()
+
 
 class CliXml(Cli):
     """ XML """
+    # 検証・整形のスレッド数 (1 = 直列)
+    workers = 1
+    # 前回から変化の無いファイルを飛ばすか？
+    incremental = False
+
+    def _results(self, fnc, task, to_result, required=None):
+        # 各ファイルにfncを実行して (ファイルパス, 結果) を返す。結果はNoneが正常、それ以外はエラー。
+        fp_gen = Xml.xml_file_generator(self.path_in)
+        if not self.incremental:
+            for fp, ret in Xml.map_files(fnc, fp_gen, workers=self.workers):
+                yield fp, to_result(ret)
+            return
+
+        root = self.path_in if os.path.isdir(self.path_in) else os.path.dirname(self.path_in)
+        manifest = XmlManifest(root, task=task)
+        try:
+            for fp, result, _ in Xml.map_files_incremental(fnc, fp_gen, manifest, to_result,
+                                                           workers=self.workers, required=required):
+                yield fp, result
+            manifest.report()
+        finally:
+            manifest.close()
 
     # =============================================
     # From here:
     #   List of functions to be called from prompt/loop
+    def set_threads(self):
+        """SetThreads
+Set thread count for CheckCorrupt and Prettify"""
+        print(f'Current Thread Count: {self.workers}')
+        workers = Prompt(f'Thread count (CPU count={os.cpu_count()}): ').get_int()
+        if workers < 1:
+            print('ERROR: Thread count must be 1 or more!')
+        else:
+            self.workers = workers
+
+    def set_incremental(self):
+        """SetIncremental
+Skip files unchanged since the last CheckCorrupt/Prettify"""
+        print(f'Current Setting: {self.incremental}')
+        self.incremental = Prompt('Skip unchanged files?').get_yes_no()
+
     def check_file_corruption(self):
         """CheckCorrupt
 Check XML File Corruption"""
@@ -133,12 +204,11 @@ Check XML File Corruption"""
         failure = 0
         fp_err_lst = []
 
-        # ループ
-        for fp in Xml.xml_file_generator(self.path_in):
-            obj = Xml(fp)
-            if obj.err:
+        # ループ (ツリーを作らずに整形式かだけを確認する。スレッドで並列に行い、結果は元の順番で集計する。)
+        for fp, err in self._results(Xml.check, 'check', XmlManifest.check_result):
+            if err:
                 print(f'File: {fp}')
-                print(f'\tError: {obj.err}')
+                print(f'\tError: {err}')
                 failure += 1
                 # 相対パスを格納する。
                 if os.path.isdir(self.path_in):
@@ -160,15 +230,24 @@ Bad Files:""")
     def count_element_names(self):
         """CountElements
 Count element names"""
+        # フォルダの場合は、全ファイルの合計だけを表示することもできる。
+        if os.path.isdir(self.path_in) and Prompt('Merge counts of all files?').get_yes_no():
+            counter, bad_lst = Xml.count_tag_names_in(self.path_in, workers=self.workers)
+            pprint.pprint(counter)
+            for fp in bad_lst:
+                print(f'ERROR: Not counted {fp}')
+            return
+
         sec = Prompt('Display Interval Seconds(int): ').get_int()
 
         for fp in Xml.xml_file_generator(self.path_in):
             print(fp)
-            obj = Xml(fp)
-            if obj.err is None:
+            # ツリー全体を読み込まずに、逐次集計する。
+            counter = Xml.iter_count_tag_names(fp)
+            if counter is not None:
                 if os.path.isdir(self.path_in):
                     print(f'File: {PathRelative(self.path_in, fp).rel_src}')
-                pprint.pprint(obj.count_tag_names())
+                pprint.pprint(counter)
 
                 for i in range(sec):
                     time.sleep(i)
@@ -181,67 +260,121 @@ Count element names"""
 Format XML and write to file in utf-8 encoding."""
         # 上書き
         over_write = Prompt('Overwrite?').get_yes_no()
+        # 作成済みのフォルダの記録とmkdirの集計 (この実行の間だけ)
+        dir_maker = DirMaker()
+
+        def prettify(fp_in):
+            # スレッドから呼ばれる。表示はせず、パースに失敗したらエラーを返す。
+            # 出力用ファイルパスを設定
+            if over_write:
+                # 上書きの場合は、入力パスを出力パスにする。
+                fp_out = fp_in
+            else:
+                # 中継相対フォルダの構築
+                obj_rel = PathRelative(dir_src=self.path_in, abs_src=fp_in, dir_dst=self.dir_out)
+                obj_rel.make_parent_dir(verbose=False, dir_maker=dir_maker)
+                fp_out = obj_rel.abs_dst
+
+            # ツリー全体を保持せずに整形して書き出す。
+            return Xml.write_pretty(fp_in, fp_out)
+
+        # 上書きしない場合は、出力ファイルが残っていることも飛ばす条件にする。
+        if over_write:
+            task = XmlManifest.pretty_task()
+            required = None
+        else:
+            task = XmlManifest.pretty_task(self.dir_out)
+            required = partial(Xml.output_path, dir_in=self.path_in, dir_out=self.dir_out)
 
-        for fp_in in Xml.xml_file_generator(self.path_in):
-            obj_xml = Xml(fp_in)
+        for fp_in, err in self._results(prettify, task, XmlManifest.pretty_result, required=required):
             obj_rel = PathRelative(dir_src=self.path_in, abs_src=fp_in, dir_dst=self.dir_out)
             print(f'processing: {obj_rel.rel_src}')
-            # 異常
-            if obj_xml.err:
+            # 異常 (エラーはここで入力順に表示する)
+            if err:
                 print(f'ERROR: Format Failure {fp_in}')
-            # 正常
-            else:
-                # 出力用ファイルパスを設定
-                if over_write:
-                    # 上書きの場合は、入力パスを出力パスにする。
-                    fp_out = fp_in
-                else:
-                    # 中継相対フォルダの構築
-                    obj_rel.make_parent_dir()
-                    fp_out = obj_rel.abs_dst
-
-                obj_xml.pretty_write_utf8(fp_out)
+                print(f'\t{err}')
+        # 中継フォルダを作った回数と、作成済みのため省略した回数
+        if not over_write:
+            dir_maker.report()
 
 
 class CliDelete(Cli):
     """ Delete """
+    # True の場合は削除せずに、対象とサイズを表示するだけ。
+    dry_run = False
 
     # =============================================
     # From here:
     #   List of functions to be called from prompt/loop
+    def set_dry_run(self):
+        """SetDryRun
+Show targets and sizes without deleting"""
+        print(f'Current Setting: {self.dry_run}')
+        self.dry_run = Prompt('Dry run?').get_yes_no()
+
     def delete_pycache(self):
         """PyCache
 Delete __pycache__ folders recursively"""
-        Delete.delete_pycache(self.path_in)
+        Delete.delete_pycache(self.path_in, dry_run=self.dry_run)
 
     def delete_sub_dirs(self):
         """SubDirBaseName
 Delete sub directories by base name"""
-        Delete.delete_folders_by_base_name(self.path_in)
+        Delete.delete_folders_by_base_name(self.path_in, dry_run=self.dry_run)
 
     def delete_file_regex(self):
         """FileRegex
 Delete files by regular expression"""
-        Delete.delete_files_by_regex(self.path_in)
+        Delete.delete_files_by_regex(self.path_in, dry_run=self.dry_run)
 
 
 class CliCopy(Cli):
     """ Copy """
+    # コピーのスレッド数
+    workers = 4
+    # 同期モード (None = 常にコピーする) と dry run
+    sync = None
+    dry_run = False
 
     # =============================================
     # From here:
     #   List of functions to be called from prompt/loop
+    def set_threads(self):
+        """SetThreads
+Set thread count for copy"""
+        print(f'Current Thread Count: {self.workers}')
+        workers = Prompt(f'Thread count (CPU count={os.cpu_count()}): ').get_int()
+        if workers < 1:
+            print('ERROR: Thread count must be 1 or more!')
+        else:
+            self.workers = workers
+
+    def set_sync(self):
+        """SetSync
+Copy only new or changed files. Dry run shows the plan without copying."""
+        print(f'Current Setting: sync={self.sync} dry_run={self.dry_run}')
+        modes = ['always'] + CopyEngine.SYNC_MODES
+        while True:
+            mode = input(f'Sync mode ({" | ".join(modes)}): ')
+            if mode in modes:
+                break
+            print(f'ERROR: {mode} is not a valid entry!')
+        self.sync = None if mode == 'always' else mode
+        self.dry_run = Prompt('Dry run?').get_yes_no()
+
     def by_regex(self):
         """ByRegex
 Copy files that match the regular expression """
         dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
-        Copy.copy_files_by_regex(dir_in, self.dir_out)
+        Copy.copy_files_by_regex(dir_in, self.dir_out, copy_workers=self.workers, sync=self.sync,
+                                 dry_run=self.dry_run)
 
     def by_modified_date(self):
         """ByModifiedDate
 Copy files that were modified after the specified date/time. """
         dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
-        Copy.copy_files_by_modified_timestamp(dir_in, self.dir_out)
+        Copy.copy_files_by_modified_timestamp(dir_in, self.dir_out, copy_workers=self.workers, sync=self.sync,
+                                              dry_run=self.dry_run)
 
 
 class CliMisc(Cli):
@@ -256,6 +389,28 @@ Count files folder and file sizes"""
         dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
         Count.count_files(dir_in)
 
+    def disk_usage(self):
+        """DiskUsage
+Disk usage by folder and extension, and the largest files"""
+        dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
+        top_n = Prompt('How many largest files/folders?').get_int()
+        depth = Prompt('Folder depth to total (1 = direct sub folders): ').get_int()
+        workers = Prompt(f'Thread count (CPU count={os.cpu_count()}): ').get_int()
+        Count.disk_usage(dir_in, workers=workers, top_n=top_n, depth=depth)
+
+    def find_duplicates(self):
+        """Duplicates
+Find files with the same content (size, head/tail hash, then full hash)"""
+        dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
+        workers = Prompt(f'Thread count (CPU count={os.cpu_count()}): ').get_int()
+        finder = Duplicate(dir_in, workers=workers).scan()
+        finder.report()
+        # 出力フォルダが設定されている場合は、グループをCSVにも書き出す。
+        if finder.groups and self.dir_out:
+            fp_out = os.path.join(self.dir_out, 'duplicates.csv')
+            finder.write_csv(fp_out)
+            print(f'INFO: saved {fp_out}')
+
     # send_toを単体で見れば「@staticmethod」でも良いように見える。
     # しかし、staticmethodにしてしまうと、Cliクラスのexe_cmdの実行でエラーになる。
     # PyCharmはフラグを立てるが、send_toはインスタンスメソッドにしておくこと。
@@ -297,6 +452,41 @@ Create regular expression template based on sample entry"""
 Grep the search result to file"""
         Grep.grep(path_in=self.path_in, dir_out=self.dir_out)
 
+    def grep_files_stream(self):
+        """GrepStream
+Grep large files chunk by chunk and write each match to file as it is found"""
+        Grep.grep(path_in=self.path_in, dir_out=self.dir_out, stream=True)
+
+    def grep_files_mmap(self):
+        """GrepMmap
+Grep ASCII/UTF-8 files with a bytes pattern on mmap, decoding only the matches.
+Falls back to text mode when the file is not ASCII and the pattern uses \\w \\d \\s \\b, '.', [^x] or IGNORECASE,
+and for files with CRLF line endings when the pattern uses '.', [^x], \\s or '$'."""
+        Grep.grep(path_in=self.path_in, dir_out=self.dir_out, use_mmap=True)
+
+    def grep_files_parallel(self):
+        """GrepParallel
+Grep files with multiple processes. The result is written in file order."""
+        workers = Prompt(f'Process count (CPU count={os.cpu_count()}): ').get_int()
+        Grep.grep(path_in=self.path_in, dir_out=self.dir_out, workers=workers)
+
+    def grep_files_table(self):
+        """GrepTable
+Grep the search result to Parquet/Feather file with typed columns"""
+        while True:
+            out_format = input('Format (parquet | feather): ')
+            if out_format in GrepTableWriter.FORMATS:
+                break
+            print(f'ERROR: {out_format} is not a valid format!')
+        Grep.grep(path_in=self.path_in, dir_out=self.dir_out, out_format=out_format)
+
+    def grep_files_multi(self):
+        """GrepMulti
+Grep files with multiple named patterns, reading each file once"""
+        print('Combining patterns scans each file once, but matches overlapping another pattern are dropped.')
+        combine = Prompt('Combine patterns into one when the results stay the same?').get_yes_no()
+        Grep.grep_multi(path_in=self.path_in, dir_out=self.dir_out, combine=combine)
+
 
 class CliTop(Cli):
     """ Top """
@@ -312,16 +502,19 @@ class CliTop(Cli):
         """XML
 Analyze XML Files"""
         self.launch(cls=CliXml,
-                    cls_fnc_lst=[CliXml.prettify_utf8,
+                    cls_fnc_lst=[CliXml.check_file_corruption,
                                  CliXml.count_element_names,
-                                 CliXml.prettify_utf8])
+                                 CliXml.prettify_utf8,
+                                 CliXml.set_threads,
+                                 CliXml.set_incremental])
 
     def dummy(self):
         """Dummy
 Create Dummy Data"""
         self.launch(cls=CliDummy,
                     cls_fnc_lst=[CliDummy.create_dummy_tree,
-                                 CliDummy.create_dummy_file_by_size])
+                                 CliDummy.create_dummy_file_by_size,
+                                 CliDummy.generate_tree])
 
     def delete(self):
         """Delete
@@ -329,14 +522,17 @@ Delete files or folders"""
         self.launch(cls=CliDelete,
                     cls_fnc_lst=[CliDelete.delete_pycache,
                                  CliDelete.delete_sub_dirs,
-                                 CliDelete.delete_file_regex])
+                                 CliDelete.delete_file_regex,
+                                 CliDelete.set_dry_run])
 
     def copy(self):
         """Copy
 Copy files"""
         self.launch(cls=CliCopy,
                     cls_fnc_lst=[CliCopy.by_regex,
-                                 CliCopy.by_modified_date])
+                                 CliCopy.by_modified_date,
+                                 CliCopy.set_threads,
+                                 CliCopy.set_sync])
 
     def grep(self):
         """Grep
@@ -345,13 +541,28 @@ Regular Expression search"""
                     cls_fnc_lst=[CliGrep.tip,
                                  CliGrep.test_rgx,
                                  CliGrep.create_rgx,
-                                 CliGrep.grep_files])
+                                 CliGrep.grep_files,
+                                 CliGrep.grep_files_stream,
+                                 CliGrep.grep_files_mmap,
+                                 CliGrep.grep_files_parallel,
+                                 CliGrep.grep_files_table,
+                                 CliGrep.grep_files_multi])
+
+    def index(self):
+        """Index
+Build/refresh file index of a folder. Later commands answer from it instead of walking."""
+        # 同じフォルダに何度もコマンドを実行する場合、2回目以降はフォルダの差分だけ辿る。
+        dir_in = Prompt('Root Folder: ').eval_dir(self.path_in)
+        persist = Prompt('Keep the index in the home folder for next time?').get_yes_no()
+        FileIndex.activate(dir_in, persist=persist)
 
     def misc(self):
         """Misc
 Features you don not use everyday"""
         self.launch(cls=CliMisc,
                     cls_fnc_lst=[CliMisc.count,
+                                 CliMisc.disk_usage,
+                                 CliMisc.find_duplicates,
                                  CliMisc.send_to])
 
 
@@ -369,7 +580,8 @@ def entry():
                                       CliTop.delete,
                                       CliTop.copy,
                                       CliTop.misc,
-                                      CliTop.grep])
+                                      CliTop.grep,
+                                      CliTop.index])
     top.print_help()
     top.prompt()
 